@@ -0,0 +1,67 @@
+"""
+Import-time budget check: every entry point imports only what its stage needs.
+
+Run from the repository root:
+    python benchmarks/import_time.py
+Exits with status 1 when an entry point is over its budget or imports a module it should not.
+"""
+import json
+import subprocess
+import sys
+from dataclasses import dataclass
+
+RENDERING = ("reportlab", "svglib", "pdf2image", "PIL")
+OSM_LAYERS = ("requests", "geopandas", "shapely")
+
+
+@dataclass(frozen=True)
+class ImportBudget:
+    name: str
+    statement: str
+    seconds: float
+    forbidden: tuple[str, ...] = ()
+
+
+BUDGETS = [
+    ImportBudget("cli", "import main", 0.5, RENDERING + OSM_LAYERS),
+    ImportBudget("extract", "import citylines.trip_extractor", 0.5, RENDERING + OSM_LAYERS),
+    ImportBudget("batch", "import citylines.batch", 0.5, RENDERING + OSM_LAYERS),
+    ImportBudget("render", "import citylines.generate_poster", 1.5, OSM_LAYERS),
+]
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+{statement}
+print(json.dumps({{"seconds": time.perf_counter() - start, "modules": sorted(sys.modules)}}))
+"""
+
+
+def measure(budget: ImportBudget, repeat: int = 3) -> tuple[float, list[str]]:
+    """
+    Best of several fresh interpreters, so that a cold file cache does not count against the budget.
+    """
+    best, modules = None, []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", PROBE.format(statement=budget.statement)],
+                                capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        if best is None or result["seconds"] < best:
+            best, modules = result["seconds"], result["modules"]
+    return best, modules
+
+
+def main() -> int:
+    failed = False
+    for budget in BUDGETS:
+        seconds, modules = measure(budget)
+        loaded = sorted({m.split(".")[0] for m in modules} & set(budget.forbidden))
+        ok = seconds <= budget.seconds and not loaded
+        failed |= not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {budget.name:8} {seconds:6.3f}s of {budget.seconds:.1f}s"
+              + (f", imports {', '.join(loaded)}" if loaded else ""))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
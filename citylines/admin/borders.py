@@ -2,14 +2,17 @@ import logging
 
 import requests
 
-from citylines.gtfs.gtfs import BoundingBox, coord2px
+from citylines.gtfs.domain import BoundingBox
+from citylines.gtfs.projection import Projection
 
 
-def _parse_osm_borders(osm_data: dict, bbox: BoundingBox) -> list:
-    nodes = {node['id']: coord2px(node['lat'], node['lon'], bbox) for node in osm_data['elements'] if node['type'] == 'node'}
+def _parse_osm_borders(osm_data: dict, projection: Projection) -> list:
+    osm_nodes = [node for node in osm_data['elements'] if node['type'] == 'node']
+    pixels = projection.project([node['lat'] for node in osm_nodes], [node['lon'] for node in osm_nodes]).tolist()
+    nodes = {node['id']: px for node, px in zip(osm_nodes, pixels)}
     ways = [way for way in osm_data['elements'] if way['type'] == 'way']
 
-    # Create a list of way paths, which are lists of node coordinates
+    # Create a list of way paths, which are lists of [x, y] node coordinates
     way_paths = []
     for way in ways:
         way_path = [nodes[node_id] for node_id in way['nodes']]
@@ -18,7 +21,7 @@ def _parse_osm_borders(osm_data: dict, bbox: BoundingBox) -> list:
     return way_paths
 
 
-def get_osm_admin_borders(place_id: str, bbox: BoundingBox) -> list:
+def get_osm_admin_borders(place_id: str, bbox: BoundingBox, projection: Projection | None = None) -> list:
     # Overpass API URL
     url = "https://overpass-api.de/api/interpreter"
 
@@ -36,6 +39,6 @@ def get_osm_admin_borders(place_id: str, bbox: BoundingBox) -> list:
 
     # Check if the request was successful
     if response.status_code == 200:
-        return _parse_osm_borders(response.json(), bbox)
+        return _parse_osm_borders(response.json(), projection or Projection(bbox))
     else:
         raise Exception(f"Overpass response error {response.status_code}: {response.text}")
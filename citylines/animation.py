@@ -0,0 +1,140 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from citylines.generate_poster import PosterScene, LevelOfDetail, route_style, get_route_color, fill_even_odd
+from citylines.gtfs.domain import RenderArea
+from citylines.gtfs.service_calendar import HOURS
+from citylines.trip_extractor import HOURLY_DIR, HOURLY_TRIPS_FILE
+from citylines.util.assets import FONTS
+from citylines.util.colors import ColorScheme
+from citylines.util.files import atomic_open
+
+WATER_RGB = (14, 20, 42)
+TEXT_RGB = (200, 200, 200)
+
+
+@dataclass(frozen=True)
+class FrameLayers:
+    """
+    Geometry shared by all frames, in frame pixels with the y axis pointing down. Only the styles
+    of the routes change from frame to frame.
+    """
+    frame_area: RenderArea
+    city: str
+    # flat x, y lists
+    routes: list[list[float]]
+    route_rgb: list[tuple[int, int, int]]
+    # (n routes, 24) trips per hour of the first departure
+    hourly_trips: np.ndarray
+    water_bodies: list[tuple[list[float], list[list[float]]]]
+    admin_borders: list[list[float]]
+
+
+def _to_frame(points, scale: float, frame_area: RenderArea) -> list[float]:
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2) * scale
+    points[:, 0] += frame_area.width_px / 2
+    points[:, 1] = frame_area.height_px / 2 - points[:, 1]
+    return points.ravel().tolist()
+
+
+def _prepare_layers(input_dir: Path, scene_area: RenderArea, frame_area: RenderArea, color_scheme: ColorScheme,
+                    city: str, add_water: bool, add_admin_borders: bool) -> FrameLayers:
+    hourly_dir = input_dir / HOURLY_DIR
+    scene = PosterScene.load(hourly_dir, scene_area, water=add_water, admin_borders=add_admin_borders,
+                             layers_dir=input_dir)
+    hourly_trips = np.load(hourly_dir / HOURLY_TRIPS_FILE)
+    # geometry is simplified once to the frame resolution, every route is kept as any hour can be its busiest
+    scene = scene.decimate(frame_area, LevelOfDetail(min_trips_ratio=0.0))
+    scale = frame_area.width_px / scene_area.width_px
+
+    colors = {}
+    route_rgb = []
+    for route in scene.routes:
+        if route.simple_route_type not in colors:
+            color = get_route_color(route.simple_route_type, color_scheme)
+            colors[route.simple_route_type] = (round(color.red * 255), round(color.green * 255),
+                                               round(color.blue * 255))
+        route_rgb.append(colors[route.simple_route_type])
+
+    return FrameLayers(frame_area, city, [_to_frame(route.points, scale, frame_area) for route in scene.routes],
+                       route_rgb, hourly_trips,
+                       [(_to_frame(exterior, scale, frame_area),
+                         [_to_frame(interior, scale, frame_area) for interior in interiors])
+                        for exterior, interiors in scene.water_bodies],
+                       [_to_frame(way_path, scale, frame_area) for way_path in scene.admin_borders])
+
+
+_layers: FrameLayers | None = None
+
+
+def _init_worker(layers: FrameLayers):
+    global _layers
+    _layers = layers
+
+
+def _render_frame(task: tuple[int, Path]) -> Path:
+    hour, out_path = task
+    layers = _layers
+    width, height = layers.frame_area.width_px, layers.frame_area.height_px
+    scaling_w = width / 9933
+    # the busiest hour of the day sets the scale of all frames, so that they can be compared
+    max_trips = float(layers.hourly_trips.max()) or 1.0
+
+    image = Image.new("RGB", (width, height), (0, 0, 0))
+    draw = ImageDraw.Draw(image, "RGBA")
+    for exterior, interiors in layers.water_bodies:
+        if len(exterior) > 4:
+            fill_even_odd(image, [exterior] + interiors, WATER_RGB)
+    for way_path in layers.admin_borders:
+        if len(way_path) > 2:
+            draw.line(way_path, fill=(255, 255, 255), width=max(1, round(20 * scaling_w)))
+
+    for points, rgb, trips in zip(layers.routes, layers.route_rgb, layers.hourly_trips[:, hour].tolist()):
+        if trips <= 0 or len(points) < 4:
+            continue
+        line_width, alpha = route_style(trips, max_trips, scaling_w)
+        draw.line(points, fill=rgb + (round(alpha * 255),), width=max(1, round(line_width)), joint="curve")
+
+    heading = ImageFont.truetype(FONTS["Garamond"], max(12, round(600 * height / 14043)))
+    label = ImageFont.truetype(FONTS["Lato"], max(10, round(300 * height / 14043)))
+    draw.text((250 * scaling_w, 250 * height / 14043), layers.city.title(), font=heading, fill=TEXT_RGB)
+    draw.text((250 * scaling_w, height - 500 * height / 14043), f"{hour:02d}:00", font=label, fill=TEXT_RGB)
+
+    image.save(out_path)
+    return out_path
+
+
+def render_animation(input_dir: Path, out_dir: Path, scene_area: RenderArea, frame_area: RenderArea,
+                     color_scheme: ColorScheme, city: str, add_water: bool = False, add_admin_borders: bool = False,
+                     gif_path: Path | None = None, frame_ms: int = 500, workers: int | None = None) -> list[Path]:
+    """
+    Renders one frame per hour of the day from the hourly routes extracted by extract_hourly_routes,
+    as frame_00.png ... frame_23.png in out_dir, e.g. for ffmpeg -i frame_%02d.png. The geometry is
+    prepared once, frames only restyle it with the trips of their hour and are rendered in parallel.
+    :param scene_area: render area the layers were extracted for
+    :param frame_area: frame size, should keep the aspect ratio of the scene
+    :param gif_path: also write the frames as a looping GIF
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    layers = _prepare_layers(input_dir, scene_area, frame_area, color_scheme, city, add_water, add_admin_borders)
+    tasks = [(hour, out_dir / f"frame_{hour:02d}.png") for hour in range(HOURS)]
+
+    frames = []
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_init_worker,
+                             initargs=(layers,)) as pool:
+        for frame in pool.map(_render_frame, tasks):
+            logging.debug(f"Frame {frame} written")
+            frames.append(frame)
+
+    if gif_path is not None:
+        images = [Image.open(frame) for frame in frames]
+        with atomic_open(gif_path, 'wb') as f:
+            images[0].save(f, format='GIF', save_all=True, append_images=images[1:], duration=frame_ms, loop=0)
+        logging.info(f"Animation written to {gif_path}")
+    return frames
@@ -0,0 +1,223 @@
+import logging
+import multiprocessing
+import os
+import resource
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable
+
+from citylines.checkpoints import StageMarker
+from citylines.gtfs.domain import RenderArea, Point, Distance
+from citylines.incremental import feed_fingerprint
+from citylines.segments_file import SEGMENTS_FILE
+from citylines.trip_extractor import get_render_bbox, extract_admin_borders, extract_routes, fetch_osm_water, \
+    add_ocean_water, WATER_FILE, OSM_WATER_FILE
+from citylines.util.colors import color_schemes
+
+NETWORK = "network"
+CPU = "cpu"
+
+
+@dataclass(frozen=True)
+class Job:
+    name: str
+    # NETWORK jobs run in threads, CPU jobs in their own process
+    resource: str
+    func: Callable
+    kwargs: dict = field(default_factory=dict)
+    depends_on: tuple[str, ...] = ()
+    # jobs with a complete marker are not run again
+    marker: StageMarker | None = None
+
+
+@dataclass(frozen=True)
+class JobResult:
+    name: str
+    error: str | None = None
+    skipped: bool = False
+    # completed by a previous run
+    resumed: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and not self.skipped
+
+
+def _init_worker(memory_limit_mb: int | None, log_level: int):
+    logging.basicConfig(level=log_level)
+    if memory_limit_mb is not None:
+        limit = memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+# layers are only fetched when their stage is incomplete, an existing file is from a run with other inputs
+def _extract_borders(center_point: Point, out_dir: Path, max_dist_y: Distance, render_area: RenderArea):
+    out_dir.mkdir(parents=True, exist_ok=True)
+    extract_admin_borders(center_point, out_dir, get_render_bbox(center_point, max_dist_y, render_area), force=True)
+
+
+def _extract_water(center_point: Point, out_dir: Path, max_dist_y: Distance, render_area: RenderArea):
+    out_dir.mkdir(parents=True, exist_ok=True)
+    fetch_osm_water(out_dir, get_render_bbox(center_point, max_dist_y, render_area))
+
+
+# the ocean shapefile is loaded whole, in a CPU worker under the memory limit
+def _extract_oceans(center_point: Point, out_dir: Path, max_dist_y: Distance, render_area: RenderArea):
+    add_ocean_water(out_dir, get_render_bbox(center_point, max_dist_y, render_area))
+
+
+def _render_poster(render_area: RenderArea, out_path: Path, input_dir: Path, city: str, logos: list[str],
+                   text: str, color_scheme: str, add_water: bool, add_admin_borders: bool):
+    # rendering dependencies are only loaded in the poster worker processes
+    from citylines.generate_poster import Poster
+
+    p = Poster(render_area, out_path=out_path, input_dir=input_dir, city=city, logos=logos, text=text)
+    p.generate_single(add_water=add_water, add_admin_borders=add_admin_borders,
+                      color_scheme=color_schemes[color_scheme])
+
+def _render_atlas(pages: list[dict], out_path: Path):
+    from citylines.generate_poster import Poster, AtlasPage, generate_atlas
+
+    generate_atlas([AtlasPage(Poster(page["render_area"], out_path=page["out_path"], input_dir=page["input_dir"],
+                                     city=page["city"], logos=page["logos"], text=page["text"]),
+                              color_schemes[page["color_scheme"]], add_water=page["add_water"],
+                              add_admin_borders=page["add_admin_borders"], title=page["title"])
+                    for page in pages], out_path)
+
+def build_jobs(place_configs: dict, render_area: RenderArea, processed_dir: Path = Path("./processed"),
+               gtfs_dir: Path = Path("./gtfs"), posters_dir: Path = Path("./posters"),
+               add_water: bool = True, add_borders: bool = True, atlas_path: Path | None = None) -> list[Job]:
+    """
+    Job graph for the places configs: OSM fetches and GTFS extraction per (city, distance),
+    followed by the poster rendering that depends on all of them. Only the Overpass queries run
+    on the network pool, the oceans are clipped from the shapefile in a CPU job.
+    Every job has a completion marker with its inputs, the poster inputs include the inputs of its layers.
+    :param atlas_path: render all posters as the pages of this PDF instead of separate files
+    """
+    jobs = []
+    atlas_pages, atlas_inputs, atlas_deps = [], [], []
+    for name, place_config in place_configs.items():
+        for max_dist in place_config["distances"]:
+            prefix = f"{name}/{max_dist}"
+            out_dir = processed_dir / name / str(max_dist)
+            layer_args = dict(center_point=place_config["center"], out_dir=out_dir,
+                              max_dist_y=Distance.from_km(max_dist), render_area=render_area)
+            # "gtfs" is a feed name, or a list of feeds covering the place
+            feeds = place_config["gtfs"]
+            feed_dirs = [str(gtfs_dir / feed) for feed in ([feeds] if isinstance(feeds, str) else feeds)]
+            layer_inputs = dict(center=place_config["center"], max_dist=max_dist, render_area=render_area)
+            routes_inputs = dict(layer_inputs, feed=feed_fingerprint(feed_dirs))
+            layer_jobs = [Job(f"{prefix}/routes", CPU, extract_routes, dict(layer_args, gtfs_dir=feed_dirs),
+                              marker=StageMarker(out_dir, "routes", routes_inputs, (out_dir / SEGMENTS_FILE,)))]
+            if add_borders:
+                layer_jobs.append(Job(f"{prefix}/borders", NETWORK, _extract_borders, layer_args,
+                                      marker=StageMarker(out_dir, "borders", layer_inputs,
+                                                         (out_dir / "borders_osm.json",))))
+            if add_water:
+                jobs.append(Job(f"{prefix}/water", NETWORK, _extract_water, layer_args,
+                                marker=StageMarker(out_dir, "water", layer_inputs, (out_dir / OSM_WATER_FILE,))))
+                layer_jobs.append(Job(f"{prefix}/oceans", CPU, _extract_oceans, layer_args,
+                                      depends_on=(f"{prefix}/water",),
+                                      marker=StageMarker(out_dir, "oceans", layer_inputs, (out_dir / WATER_FILE,))))
+            jobs.extend(layer_jobs)
+
+            poster_args = dict(render_area=render_area, out_path=posters_dir / f"{name}-{max_dist}.pdf",
+                               input_dir=out_dir, city=name, logos=place_config["logos"], text="",
+                               color_scheme=place_config.get("color_scheme", "default"),
+                               add_water=add_water, add_admin_borders=add_borders)
+            poster_inputs = dict(poster_args, layers={job.marker.stage: job.marker.inputs for job in layer_jobs})
+            if atlas_path is not None:
+                atlas_pages.append(dict(poster_args, title=f"{name.title()} {max_dist} km"))
+                atlas_inputs.append(poster_inputs)
+                atlas_deps.extend(job.name for job in layer_jobs)
+                continue
+            jobs.append(Job(f"{prefix}/poster", CPU, _render_poster, poster_args,
+                            depends_on=tuple(job.name for job in layer_jobs),
+                            marker=StageMarker(out_dir, "poster", poster_inputs, (poster_args["out_path"],))))
+
+    if atlas_pages:
+        jobs.append(Job("atlas", CPU, _render_atlas, dict(pages=atlas_pages, out_path=atlas_path),
+                        depends_on=tuple(atlas_deps),
+                        marker=StageMarker(processed_dir, f"atlas-{atlas_path.stem}", dict(pages=atlas_inputs),
+                                           (atlas_path,))))
+    return jobs
+
+class BatchRunner:
+    """
+    Runs a job graph with separate concurrency limits for network and CPU jobs.
+
+    Every CPU job runs in its own worker process with an optional address space limit,
+    so that a crash or an out-of-memory feed only fails its own job and the jobs depending on it.
+    Jobs whose completion marker is complete are not run again, an interrupted run resumes
+    at the first incomplete stage of every place.
+    """
+
+    def __init__(self, network_workers: int = 4, cpu_workers: int | None = None, memory_limit_mb: int | None = None):
+        self.limits = {NETWORK: network_workers, CPU: cpu_workers or os.cpu_count() or 1}
+        self.memory_limit_mb = memory_limit_mb
+
+    def _run_job(self, job: Job):
+        if job.resource == NETWORK:
+            return job.func(**job.kwargs)
+        # forkserver: forking the multithreaded scheduler process directly is unsafe
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("forkserver"),
+                                 initializer=_init_worker,
+                                 initargs=(self.memory_limit_mb, logging.getLogger().getEffectiveLevel())) as pool:
+            return pool.submit(job.func, **job.kwargs).result()
+
+    def run(self, jobs: list[Job], resume: bool = True) -> dict[str, JobResult]:
+        """
+        :param resume: skip jobs completed by a previous run, False runs all jobs again
+        """
+        results = {}
+        pending = {job.name: job for job in jobs}
+        running = {}
+        busy = {NETWORK: 0, CPU: 0}
+
+        for job in jobs:
+            unknown = [d for d in job.depends_on if d not in pending]
+            if unknown:
+                raise ValueError(f"{job.name} depends on unknown jobs: {', '.join(unknown)}")
+
+        with ThreadPoolExecutor(max_workers=sum(self.limits.values())) as executor:
+            while pending or running:
+                scheduled = True
+                while scheduled:
+                    scheduled = False
+                    for name, job in list(pending.items()):
+                        failed_deps = [d for d in job.depends_on if d in results and not results[d].ok]
+                        if failed_deps:
+                            logging.warning(f"Skipping {name}, failed dependencies: {', '.join(failed_deps)}")
+                            results[name] = JobResult(name, skipped=True)
+                        elif resume and job.marker is not None and job.marker.is_complete():
+                            logging.info(f"{name} was completed by a previous run")
+                            results[name] = JobResult(name, resumed=True)
+                        elif all(d in results for d in job.depends_on) and \
+                                busy[job.resource] < self.limits[job.resource]:
+                            logging.info(f"Starting {name}")
+                            busy[job.resource] += 1
+                            running[executor.submit(self._run_job, job)] = job
+                        else:
+                            continue
+                        del pending[name]
+                        scheduled = True
+
+                if not running:
+                    if pending:
+                        raise ValueError(f"Cyclic dependencies between jobs: {', '.join(pending)}")
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    busy[job.resource] -= 1
+                    try:
+                        future.result()
+                        if job.marker is not None:
+                            job.marker.complete()
+                        results[job.name] = JobResult(job.name)
+                        logging.info(f"Finished {job.name}")
+                    except Exception as e:
+                        logging.error(f"{job.name} failed: {e!r}")
+                        results[job.name] = JobResult(job.name, error=repr(e))
+        return results
@@ -0,0 +1,42 @@
+import datetime
+import json
+from dataclasses import dataclass
+from pathlib import Path
+
+from citylines.util.files import atomic_open
+
+MARKERS_DIR = ".stages"
+
+
+@dataclass(frozen=True)
+class StageMarker:
+    """
+    Completion marker of one stage of a place, written to {out_dir}/.stages/{stage}.json with the inputs
+    the stage ran with. A stage is complete when its marker records the same inputs and its outputs exist.
+    """
+    out_dir: Path
+    stage: str
+    inputs: dict
+    outputs: tuple[Path, ...] = ()
+
+    @property
+    def path(self) -> Path:
+        return self.out_dir / MARKERS_DIR / f"{self.stage}.json"
+
+    def normalized_inputs(self) -> dict:
+        # compared with the inputs read back from JSON
+        return json.loads(json.dumps(self.inputs, sort_keys=True, default=str))
+
+    def is_complete(self) -> bool:
+        try:
+            with open(self.path, 'r') as f:
+                marker = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+        return marker.get("inputs") == self.normalized_inputs() and all(path.exists() for path in self.outputs)
+
+    def complete(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_open(self.path) as f:
+            json.dump({"stage": self.stage, "inputs": self.normalized_inputs(),
+                       "completed_at": datetime.datetime.now().isoformat(timespec='seconds')}, f)
@@ -0,0 +1,151 @@
+import logging
+import math
+from typing import Iterator
+
+import numpy as np
+from PIL import Image
+
+from citylines.generate_poster import SceneRoute, get_route_color
+from citylines.gtfs.domain import RenderArea
+from citylines.util.colors import ColorScheme
+
+# pixels of the output accumulated and colored at once, bounds the memory whatever the page size
+BAND_PIXELS = 1 << 21
+
+
+def _route_pairs(routes: list[SceneRoute], scale: float, render_area: RenderArea):
+    """
+    Consecutive point pairs of all routes in output pixels (x pointing right, y pointing down from the top),
+    with the trips and simplified route type of their route.
+    """
+    lengths = np.array([len(route.points) for route in routes], dtype=np.int64)
+    if not len(routes) or lengths.sum() == 0:
+        return np.zeros((0, 4)), np.zeros(0), np.zeros(0, dtype=np.int32)
+    points = np.concatenate([route.points for route in routes]).astype(np.float64) * scale
+    points[:, 0] += render_area.width_px / 2
+    points[:, 1] = render_area.height_px / 2 - points[:, 1]
+
+    # a pair must not connect the last point of a route with the first point of the next one
+    route_ids = np.repeat(np.arange(len(routes)), lengths)
+    same_route = route_ids[1:] == route_ids[:-1]
+    pairs = np.concatenate([points[:-1], points[1:]], axis=1)[same_route]
+    pair_routes = route_ids[:-1][same_route]
+    trips = np.array([route.trips for route in routes], dtype=np.float64)[pair_routes]
+    types = np.array([route.simple_route_type for route in routes], dtype=np.int32)[pair_routes]
+    return pairs, trips, types
+
+
+def _rasterize(pairs: np.ndarray, weights: np.ndarray, window: tuple[int, int, int, int]) -> np.ndarray:
+    """
+    Sums the weights of the pairs into a grid of the (top, bottom, left, right) window: every pair is sampled
+    once per pixel of its longer axis, without its end point, which is the start point of the next pair.
+    """
+    top, bottom, left, right = window
+    width = right - left
+    deltas = pairs[:, 2:] - pairs[:, :2]
+    counts = np.maximum(np.ceil(np.abs(deltas).max(axis=1)), 1).astype(np.int64)
+    pair_ids = np.repeat(np.arange(len(pairs)), counts)
+    steps = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    t = (steps / counts[pair_ids])[:, None]
+    samples = np.floor(pairs[pair_ids, :2] + deltas[pair_ids] * t).astype(np.int64) - [left, top]
+
+    inside = (samples[:, 0] >= 0) & (samples[:, 0] < width) & (samples[:, 1] >= 0) & (samples[:, 1] < bottom - top)
+    cells = samples[inside, 1] * width + samples[inside, 0]
+    grid = np.bincount(cells, weights=weights[pair_ids[inside]], minlength=(bottom - top) * width)
+    return grid.reshape(-1, width)
+
+
+def _spread(grid: np.ndarray, radius: int) -> np.ndarray:
+    """
+    Widens one pixel lines to 2 * radius + 1 pixels with a separable box filter of shifted sums,
+    which for the few pixels wide lines of a poster is cheaper than summed area tables.
+    The result is scaled so that an isolated line keeps its value.
+    """
+    for axis in (0, 1):
+        spread = grid.copy()
+        n = grid.shape[axis]
+        for shift in range(1, min(radius, n - 1) + 1):
+            if axis == 0:
+                spread[shift:] += grid[:-shift]
+                spread[:-shift] += grid[shift:]
+            else:
+                spread[:, shift:] += grid[:, :-shift]
+                spread[:, :-shift] += grid[:, shift:]
+        grid = spread
+    return grid / (2 * radius + 1)
+
+
+def density_bands(routes: list[SceneRoute], scene_area: RenderArea, render_area: RenderArea,
+                  color_scheme: ColorScheme, line_width_px: float | None = None) -> Iterator[tuple[int, Image.Image]]:
+    """
+    Renders the routes as a trip-density heatmap: the trips of every route are summed into a grid per
+    simplified route type at output resolution, tone-mapped on a log scale relative to the busiest route
+    and colored with the route type colors. Overlapping route types are blended with screen.
+
+    The heatmap is built in bands of rows, so that memory stays bounded at any page size, while the time
+    depends on the number of pixels and the total length of the routes, not on the number of routes.
+    Yields (top row, RGBA image) of the bands with routes, transparent where there are none.
+    :param scene_area: render area the route points are in, relative to its center
+    :param line_width_px: width of the lines in output pixels, defaults to 7 px of an A0 poster
+    """
+    width, height = render_area.width_px, render_area.height_px
+    scale = width / scene_area.width_px
+    if line_width_px is None:
+        line_width_px = 7 * width / 9933
+    radius = max(0, round((line_width_px - 1) / 2))
+
+    pairs, trips, types = _route_pairs(routes, scale, render_area)
+    # the routes extend beyond the page
+    on_page = (pairs[:, [0, 2]].max(axis=1) >= -radius) & (pairs[:, [0, 2]].min(axis=1) < width + radius)
+    pairs, trips, types = pairs[on_page], trips[on_page], types[on_page]
+    max_trips = max((route.trips for route in routes), default=0)
+    reference = math.log1p(max_trips) or 1.0
+    # route types of the same color share one grid
+    colors = {}
+    for simple_type in np.unique(types).tolist():
+        color = get_route_color(simple_type, color_scheme)
+        colors.setdefault(color.hexval(), (np.array([color.red, color.green, color.blue]), []))[1].append(simple_type)
+
+    rows_per_band = max(1, BAND_PIXELS // width)
+    pair_top = np.minimum(pairs[:, 1], pairs[:, 3])
+    pair_bottom = np.maximum(pairs[:, 1], pairs[:, 3])
+    pair_left = np.minimum(pairs[:, 0], pairs[:, 2])
+    pair_right = np.maximum(pairs[:, 0], pairs[:, 2])
+    for top in range(0, height, rows_per_band):
+        bottom = min(top + rows_per_band, height)
+        # lines of neighbouring bands are spread into this one
+        rows = (max(0, top - radius), min(height, bottom + radius))
+        in_band = (pair_bottom >= rows[0]) & (pair_top < rows[1])
+        if not in_band.any():
+            continue
+
+        # screen blending: 1 - product of (1 - layer), only updated where a layer has trips
+        inverse_rgb = np.ones(((bottom - top) * width, 3), dtype=np.float32)
+        inverse_alpha = np.ones((bottom - top) * width, dtype=np.float32)
+        for color, simple_types in colors.values():
+            selected = in_band & np.isin(types, simple_types)
+            if not selected.any():
+                continue
+            # only the columns the routes cover are accumulated
+            left = max(0, math.floor(pair_left[selected].min()) - radius)
+            right = min(width, math.floor(pair_right[selected].max()) + radius + 1)
+            grid = _rasterize(pairs[selected], trips[selected], (*rows, left, right))
+            if radius:
+                grid = _spread(grid, radius)
+            grid = grid[top - rows[0]:bottom - rows[0]]
+            band_rows, band_cols = np.nonzero(grid)
+            intensity = np.minimum(np.log1p(grid[band_rows, band_cols]) / reference, 1.0)
+            cells = band_rows * width + band_cols + left
+            inverse_rgb[cells] *= 1.0 - intensity[:, None] * color
+            inverse_alpha[cells] *= 1.0 - intensity
+
+        covered = np.flatnonzero(inverse_alpha < 1.0)
+        if not len(covered):
+            continue
+        alpha = 1.0 - inverse_alpha[covered]
+        band = np.zeros(((bottom - top) * width, 4), dtype=np.uint8)
+        band[covered, :3] = np.round(np.clip((1.0 - inverse_rgb[covered]) / alpha[:, None], 0.0, 1.0) * 255)
+        band[covered, 3] = np.round(alpha * 255)
+        yield top, Image.fromarray(band.reshape(bottom - top, width, 4), "RGBA")
+
+    logging.debug(f"Density image {width}x{height} from {len(pairs)} route point pairs of {len(routes)} routes")
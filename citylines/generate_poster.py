@@ -1,24 +1,212 @@
 import json
-from dataclasses import dataclass
+import logging
+from dataclasses import dataclass, replace
 from pathlib import Path
 
+import numpy as np
 from PIL import Image, ImageDraw
 
 from pdf2image import convert_from_path
 
-from reportlab.pdfbase import pdfmetrics
-from reportlab.graphics.shapes import Polygon, Drawing
-from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.pdfgen import canvas
-from reportlab.graphics import renderPDF
 from reportlab.lib.colors import Color, HexColor
+from reportlab.lib.utils import ImageReader
 import math
 
 from reportlab.pdfgen.canvas import Canvas
-from svglib.svglib import svg2rlg
 
 from citylines.gtfs.domain import RenderArea
+from citylines.segments_file import SegmentsFile, SEGMENTS_FILE
+from citylines.util.assets import register_fonts, draw_logo
 from citylines.util.colors import ColorScheme
+from citylines.util.files import atomic_open
+
+WATER_COLOR = "#0e142a"
+
+
+def to_xy(point) -> tuple[float, float]:
+    # layers extracted by older versions store points as {"x": .., "y": ..} dicts
+    return (point["x"], point["y"]) if isinstance(point, dict) else point
+
+
+def read_max_trips(input_dir: Path) -> float:
+    return float(SegmentsFile.open(input_dir / SEGMENTS_FILE).max_trips)
+
+
+def route_style(trips: float, max_trips: float, scaling_w: float) -> tuple[float, float]:
+    """
+    Line width (in render area pixels) and alpha of a route with the given number of trips.
+    """
+    factor = 1.7
+    stroke_weight = math.log(trips * factor) * 3
+    if stroke_weight < 0:
+        stroke_weight = 1.0 * factor
+
+    alph = 100 * (trips / max_trips)
+    if alph < 20.0:
+        alph = 20.0
+    return stroke_weight * scaling_w, alph / 255.0
+
+
+@dataclass(frozen=True)
+class SceneRoute:
+    trips: float
+    simple_route_type: int
+    line_width: float
+    alpha: float
+    points: np.ndarray
+
+
+@dataclass(frozen=True)
+class LevelOfDetail:
+    """
+    Decimation of a scene rendered to a smaller render area, sizes are in pixels of that render area.
+    """
+    # points closer than this are merged
+    tolerance_px: float = 1.0
+    # routes with fewer trips than this fraction of the busiest route are dropped
+    min_trips_ratio: float = 0.02
+    # water bodies, islands and border paths smaller than this are dropped
+    min_feature_px: float = 2.0
+
+
+def _simplify(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Approximate line simplification. Consecutive points in the same grid cell are merged first,
+    then nearly collinear points are dropped: every other point per pass, so that the neighbours
+    they are measured against stay in place.
+    """
+    if len(points) <= 2:
+        return points
+    grid = np.floor(points / tolerance)
+    keep = np.empty(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    keep[1:-1] = (grid[1:-1] != grid[:-2]).any(axis=1)
+    points = points[keep]
+
+    idle_passes, offset = 0, 1
+    while len(points) > 2 and idle_passes < 2:
+        xy = points.astype(np.float64)
+        mid = np.arange(offset, len(points) - 1, 2)
+        if not len(mid):
+            break
+        start, end = xy[mid - 1], xy[mid + 1]
+        chord = end - start
+        to_mid = xy[mid] - start
+        chord_length = np.hypot(chord[:, 0], chord[:, 1])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            deviation = np.where(chord_length > 0,
+                                 np.abs(chord[:, 0] * to_mid[:, 1] - chord[:, 1] * to_mid[:, 0]) / chord_length,
+                                 np.hypot(to_mid[:, 0], to_mid[:, 1]))
+        drop = mid[deviation < tolerance / 2]
+        idle_passes = 0 if len(drop) else idle_passes + 1
+        points = np.delete(points, drop, axis=0)
+        offset = 2 if offset == 1 else 1
+    return points
+
+
+@dataclass(frozen=True)
+class PosterScene:
+    """
+    Processed layers of a place, parsed once and shared by all poster variants rendered from it.
+    Coordinates are in pixels of the render area the layers were extracted for, relative to its center.
+    """
+    render_area: RenderArea
+    routes: list[SceneRoute]
+    # (exterior, interiors) as flat x, y lists
+    water_bodies: list[tuple[list[float], list[list[float]]]]
+    admin_borders: list[list[tuple[float, float]]]
+
+    @staticmethod
+    def load(input_dir: Path, render_area: RenderArea, water: bool = False, admin_borders: bool = False,
+             layers_dir: Path | None = None) -> 'PosterScene':
+        """
+        :param layers_dir: directory of the water and border layers, defaults to input_dir
+        """
+        layers_dir = layers_dir or input_dir
+        return PosterScene(render_area, PosterScene._load_routes(input_dir, render_area),
+                           PosterScene._load_water_bodies(layers_dir) if water else [],
+                           PosterScene._load_admin_borders(layers_dir) if admin_borders else [])
+
+    def decimate(self, render_area: RenderArea, lod: LevelOfDetail) -> 'PosterScene':
+        """
+        Drops and simplifies what is not visible when the scene is rendered to a smaller render area.
+        Coordinates stay in pixels of the scene render area.
+        """
+        scale = render_area.width_px / self.render_area.width_px
+        cell = lod.tolerance_px / scale
+        min_extent = lod.min_feature_px / scale
+
+        def is_visible(points: np.ndarray) -> bool:
+            return len(points) > 1 and np.ptp(points, axis=0).max() >= min_extent
+
+        max_trips = max((route.trips for route in self.routes), default=0)
+        routes = [replace(route, points=_simplify(route.points, cell)) for route in self.routes
+                  if route.trips >= max_trips * lod.min_trips_ratio]
+
+        water_bodies = []
+        for exterior, interiors in self.water_bodies:
+            exterior = np.array(exterior, dtype=np.float64).reshape(-1, 2)
+            if not is_visible(exterior):
+                continue
+            interiors = [np.array(interior, dtype=np.float64).reshape(-1, 2) for interior in interiors]
+            water_bodies.append((_simplify(exterior, cell).ravel().tolist(),
+                                 [_simplify(interior, cell).ravel().tolist()
+                                  for interior in interiors if is_visible(interior)]))
+
+        admin_borders = []
+        for way_path in self.admin_borders:
+            points = np.array(way_path, dtype=np.float64).reshape(-1, 2)
+            if is_visible(points):
+                admin_borders.append([tuple(point) for point in _simplify(points, cell).tolist()])
+
+        logging.debug(f"Level of detail: {len(routes)}/{len(self.routes)} routes, "
+                      f"{sum(len(r.points) for r in routes)}/{sum(len(r.points) for r in self.routes)} route points, "
+                      f"{len(water_bodies)}/{len(self.water_bodies)} water bodies, "
+                      f"{len(admin_borders)}/{len(self.admin_borders)} border paths")
+        return PosterScene(self.render_area, routes, water_bodies, admin_borders)
+
+    @staticmethod
+    def _load_routes(input_dir: Path, render_area: RenderArea) -> list[SceneRoute]:
+        segments = SegmentsFile.open(input_dir / SEGMENTS_FILE)
+        max_trips = float(segments.max_trips)
+        scaling_w = render_area.width_px / 9933
+        routes = []
+
+        for trips, route_type, points in segments:
+            line_width, alpha = route_style(trips, max_trips, scaling_w)
+            simple_route_type = to_simple_gtfs_type(route_type)
+            routes.append(SceneRoute(trips, simple_route_type, line_width, alpha, points))
+        return routes
+
+    @staticmethod
+    def _load_water_bodies(input_dir: Path) -> list[tuple[list[float], list[list[float]]]]:
+        with open(input_dir / "water_bodies_osm.json", 'r') as f:
+            water_bodies = json.load(f)
+
+        return [([coord for point in body["nodes"] for coord in to_xy(point)],
+                 [[coord for point in interior for coord in to_xy(point)]
+                  for interior in body.get("interiors", [])])
+                for body in water_bodies]
+
+    @staticmethod
+    def _load_admin_borders(input_dir: Path) -> list[list[tuple[float, float]]]:
+        with open(input_dir / "borders_osm.json", 'r') as f:
+            way_paths = json.load(f)
+
+        return [[to_xy(node) for node in way_path] for way_path in way_paths if way_path]
+
+
+@dataclass(frozen=True)
+class PosterVariant:
+    out_path: Path
+    color_scheme: ColorScheme
+    add_water: bool = False
+    add_admin_borders: bool = False
+    # defaults to the text of the poster
+    text: str | None = None
+    # defaults to the render area of the poster, should keep its aspect ratio
+    render_area: RenderArea | None = None
 
 
 @dataclass
@@ -29,6 +217,8 @@ class Poster:
     city: str
     text: str
     logos: list[str]
+    # draw logos through PDF form XObjects
+    logo_forms: bool = False
 
     def __post_init__(self):
         self.logo_gap = 70*self.scaling_w
@@ -61,25 +251,74 @@ class Poster:
             total_w += provider_w + self.logo_gap
         return total_w
 
-    def generate_single(self,  color_scheme: ColorScheme, add_water: bool = False, add_admin_borders: bool = False):
-        pdfmetrics.registerFont(TTFont('Lato', 'assets/fonts/Lato-Regular.ttf'))
-        pdfmetrics.registerFont(TTFont('Garamond', 'assets/fonts/EBGaramond-VariableFont_wght.ttf'))
+    def generate_single(self,  color_scheme: ColorScheme, add_water: bool = False, add_admin_borders: bool = False,
+                        density: bool = False):
+        scene = PosterScene.load(self.input_dir, self.render_area, water=add_water, admin_borders=add_admin_borders)
+        self.render_scene(scene, color_scheme, add_water=add_water, add_admin_borders=add_admin_borders,
+                          density=density)
+
+    def generate_variants(self, variants: list[PosterVariant]):
+        """
+        Renders several variants of the poster (color scheme, layers, text, size)
+        while reading and parsing the processed layers only once.
+        """
+        scene = PosterScene.load(self.input_dir, self.render_area,
+                                 water=any(v.add_water for v in variants),
+                                 admin_borders=any(v.add_admin_borders for v in variants))
+        for variant in variants:
+            poster = replace(self, out_path=variant.out_path,
+                             render_area=variant.render_area or self.render_area,
+                             text=self.text if variant.text is None else variant.text)
+            poster.render_scene(scene, variant.color_scheme,
+                                add_water=variant.add_water, add_admin_borders=variant.add_admin_borders)
+
+    def generate_preview(self, render_area: RenderArea, color_scheme: ColorScheme, add_water: bool = False,
+                         add_admin_borders: bool = False, lod: LevelOfDetail = LevelOfDetail()):
+        """
+        Renders a small version of the poster from the same processed layers, with details below
+        the preview resolution left out.
+        :param render_area: preview size, should keep the aspect ratio of the poster
+        """
+        scene = PosterScene.load(self.input_dir, self.render_area, water=add_water, admin_borders=add_admin_borders)
+        preview = replace(self, render_area=render_area)
+        preview.render_scene(scene.decimate(render_area, lod), color_scheme,
+                             add_water=add_water, add_admin_borders=add_admin_borders)
+
+    def render_scene(self, scene: PosterScene, color_scheme: ColorScheme,
+                     add_water: bool = False, add_admin_borders: bool = False, density: bool = False):
+        """
+        :param density: draw the routes as a trip-density heatmap image instead of one line per route
+        """
+        register_fonts()
 
         self.out_path.parent.mkdir(parents=True, exist_ok=True)
 
+        # the PDF replaces out_path only once it is complete
+        with atomic_open(self.out_path, 'wb') as f:
+            c = canvas.Canvas(f)
+            self._draw_page(c, scene, color_scheme, add_water, add_admin_borders, density)
+            c.save()
+
+    def _draw_page(self, c: Canvas, scene: PosterScene, color_scheme: ColorScheme,
+                   add_water: bool, add_admin_borders: bool, density: bool):
+        """
+        Draws the poster as the next page of the document.
+        """
         # reportlab measures in physical mm, not px, 0.24 is a scale factor
-        c = canvas.Canvas(str(self.out_path),
-                          pagesize=(self.render_area.width_px*0.24, self.render_area.height_px*0.24))
+        c.setPageSize((self.render_area.width_px*0.24, self.render_area.height_px*0.24))
         c.scale(0.24, 0.24)
         c.setLineWidth(1)
         c.setFillColorRGB(0, 0, 0)
         c.rect(0, 0, self.render_area.width_px, self.render_area.height_px, fill=1)
 
         if add_water:
-            self._draw_water_bodies(c)
+            self._draw_water_bodies(c, scene)
         if add_admin_borders:
-            self._draw_admin_borders(c)
-        self._draw_routes(c, color_scheme)
+            self._draw_admin_borders(c, scene)
+        if density:
+            self._draw_density(c, scene, color_scheme)
+        else:
+            self._draw_routes(c, scene, color_scheme)
 
         c.setFont("Lato", self.font_size)
         total_w = self._draw_logos(c)
@@ -100,21 +339,9 @@ class Poster:
         c.drawString(self.heading_start_x, self.heading_start_y, self.city.title())
 
         c.showPage()
-        c.save()
 
     def _draw_svg_on_pdf(self, canvas, svg_path, x, y, height):
-        drawing = svg2rlg(svg_path)
-
-        # If only height is provided, calculate the scaling factor based on the height,
-        # then compute the resultant width based on the original aspect ratio.
-        scaling_factor = height / drawing.height
-        resultant_width = drawing.width * scaling_factor
-        drawing.width = resultant_width
-        drawing.height = height
-        drawing.scale(scaling_factor, scaling_factor)
-        renderPDF.draw(drawing, canvas, x, y)
-
-        return drawing.width, drawing.height
+        return draw_logo(canvas, svg_path, x, y, height, as_form=self.logo_forms)
 
     def apply_fade_effect(self):
         out_path = self._convert_pdf_to_png()
@@ -141,109 +368,86 @@ class Poster:
         return out_path
 
     def get_max_lines(self) -> float:
-        with open(self.input_dir / "maxmin.lines", 'r') as file:
-            max_val = float(file.readline().strip())
-            return max_val
+        return read_max_trips(self.input_dir)
 
-    def _draw_routes(self, c: Canvas, color_scheme: ColorScheme):
-        max_trips = self.get_max_lines()
+    def _enter_scene(self, c: Canvas, scene: PosterScene) -> float:
+        """
+        Moves the origin to the poster center and scales scene pixels to poster pixels.
+        Returns the scale factor.
+        """
         c.saveState()
         c.translate(self.render_area.width_px / 2, self.render_area.height_px / 2)
+        scale_x = self.render_area.width_px / scene.render_area.width_px
+        scale_y = self.render_area.height_px / scene.render_area.height_px
+        c.scale(scale_x, scale_y)
+        return scale_y
+
+    def _draw_routes(self, c: Canvas, scene: PosterScene, color_scheme: ColorScheme):
+        self._enter_scene(c, scene)
+        colors = {}
+
+        for route in scene.routes:
+            if route.simple_route_type not in colors:
+                colors[route.simple_route_type] = get_route_color(route.simple_route_type, color_scheme)
+            color = colors[route.simple_route_type]
+
+            # line widths are in scene pixels, so that they scale together with the geometry
+            c.setLineWidth(route.line_width)
+            c.setLineCap(2)  # square
+
+            if route.simple_route_type == 15:
+                # water transport
+                c.setDash(10, 30)
+                color_alpha = Color(color.red, color.green, color.blue, 0.4)
+                c.setStrokeColor(color_alpha)
+            else:
+                color_alpha = Color(color.red, color.green, color.blue, route.alpha)
+                c.setStrokeColor(color_alpha)
+                c.setDash([])
 
-        with open(self.input_dir / "data.lines", 'r') as file:
-            for lineS in file:
-                line = lineS.split("\t")
-                trips = line[0]
-                route_types = line[1].split(",")
-
-                for route_type in route_types:
-                    simple_route_type = to_simple_gtfs_type(int(route_type))
-                    color = get_route_color(simple_route_type, color_scheme)
-                    points = line[2].split(",")
-
-                    factor = 1.7
-                    stroke_weight = math.log(float(trips) * factor) * 3
-                    if stroke_weight < 0:
-                        stroke_weight = 1.0 * factor
-
-                    c.setLineWidth(stroke_weight*self.scaling_w)
-                    alph = 100 * (float(trips) / max_trips)
-                    if alph < 20.0:
-                        alph = 20.0
-
-                    c.setLineCap(2)  # square
-
-                    if simple_route_type == 15:
-                        # water transport
-                        c.setDash(10, 30)
-                        color_alpha = Color(color.red, color.green, color.blue, 0.4)
-                        c.setStrokeColor(color_alpha)
-                    else:
-                        color_alpha = Color(color.red, color.green, color.blue, alph / 255.0)
-                        c.setStrokeColor(color_alpha)
-                        c.setDash([])
-
-                    path = c.beginPath()
-                    for index, point in enumerate(points):
-                        x, y = float(point.split(" ")[0]), float(point.split(" ")[1])
-                        if index == 0:
-                            path.moveTo(x, y)
-                        else:
-                            path.lineTo(x, y)
-                    c.drawPath(path)
-                    path.close()
+            path = c.beginPath()
+            for index, (x, y) in enumerate(route.points.tolist()):
+                if index == 0:
+                    path.moveTo(x, y)
+                else:
+                    path.lineTo(x, y)
+            c.drawPath(path)
+            path.close()
         c.restoreState()
 
-    def _draw_water_bodies(self, c):
-        c.saveState()
-        c.translate(self.render_area.width_px / 2, self.render_area.height_px / 2)
+    def _draw_density(self, c: Canvas, scene: PosterScene, color_scheme: ColorScheme):
+        from citylines.density import density_bands
 
-        with open(self.input_dir / "water_bodies_osm.json", 'r') as f:
-            water_bodies = json.load(f)
+        # bands are embedded as separate images, so that the whole page is never in memory at once
+        for top, band in density_bands(scene.routes, scene.render_area, self.render_area, color_scheme):
+            c.drawImage(ImageReader(band), 0, self.render_area.height_px - top - band.height,
+                        band.width, band.height, mask='auto')
 
-        c.setDash([])
-        canvas_width = c._pagesize[0]
-        canvas_height = c._pagesize[1]
-
-        # Create a Drawing with the same size as the Canvas
-        d = Drawing(canvas_width, canvas_height)
-        for body in water_bodies:
-            points = [coord for point in body["nodes"] for coord in (point["x"], point["y"])]
-            # Add a Polygon or any other shapes to the Drawing
-            if len(points) > 2:
-                polygon = Polygon(points, fillColor='#0e142a')
-                d.add(polygon)
-
-            # add islands with black on top
-            if "interiors" in body:
-                for interior in body["interiors"]:
-                    int_points = [coord for point in interior for coord in (point["x"], point["y"])]
-                    if len(int_points) > 2:
-                        polygon = Polygon(int_points, fillColor='#000000')
-                        d.add(polygon)
-        renderPDF.draw(d, c, 0, 0)
+    def _draw_water_bodies(self, c: Canvas, scene: PosterScene):
+        self._enter_scene(c, scene)
+        c.setFillColor(HexColor(WATER_COLOR))
 
-        c.restoreState()
+        # all bodies share the fill color set above, every body is a single path filled with f*
+        for exterior, interiors in scene.water_bodies:
+            rings = [_ring_operators(ring) for ring in [exterior] + interiors if len(ring) > 4]
+            if rings:
+                # islands are holes of the same even-odd path, so that they do not cover other water bodies
+                c.addLiteral("".join(rings) + "f*")
 
-    def _draw_admin_borders(self, c):
-        c.saveState()
-        c.translate(self.render_area.width_px / 2, self.render_area.height_px / 2)
+        c.restoreState()
 
-        with open(self.input_dir / "borders_osm.json", 'r') as f:
-            way_paths = json.load(f)
+    def _draw_admin_borders(self, c, scene: PosterScene):
+        scale = self._enter_scene(c, scene)
 
         c.setStrokeColorRGB(150, 150, 150)
-        c.setLineWidth(20)
-
-        for way_path in way_paths:
-            if not way_path:
-                continue
+        c.setLineWidth(20 / scale)
 
+        for way_path in scene.admin_borders:
             path = c.beginPath()
-            path.moveTo(way_path[0]['x'], way_path[0]['y'])
+            path.moveTo(*way_path[0])
 
-            for node in way_path[1:]:
-                path.lineTo(node['x'], node['y'])
+            for x, y in way_path[1:]:
+                path.lineTo(x, y)
 
             c.drawPath(path)
             path.close()
@@ -251,6 +455,81 @@ class Poster:
         c.restoreState()
 
 
+@dataclass(frozen=True)
+class AtlasPage:
+    poster: Poster
+    color_scheme: ColorScheme
+    add_water: bool = False
+    add_admin_borders: bool = False
+    density: bool = False
+    # outline entry of the page, defaults to the city name
+    title: str | None = None
+
+
+def generate_atlas(pages: list[AtlasPage], out_path: Path) -> Path:
+    """
+    Renders posters as the pages of a single PDF, e.g. a city at several distances or all places of a country.
+    Fonts, logo forms and graphics states are embedded once and referenced from every page. The layers
+    of a page are loaded only while it is drawn, so that one scene is held in memory at a time.
+    """
+    if not pages:
+        raise ValueError("An atlas needs at least one page")
+    register_fonts()
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+
+    with atomic_open(out_path, 'wb') as f:
+        c = canvas.Canvas(f)
+        for i, page in enumerate(pages):
+            # pages of the same size draw the same logos, which are embedded once as forms
+            poster = replace(page.poster, logo_forms=True)
+            scene = PosterScene.load(poster.input_dir, poster.render_area, water=page.add_water,
+                                     admin_borders=page.add_admin_borders)
+            key = f"page{i}"
+            c.bookmarkPage(key)
+            c.addOutlineEntry(page.title or poster.city.title(), key)
+            poster._draw_page(c, scene, page.color_scheme, page.add_water, page.add_admin_borders, page.density)
+            logging.debug(f"Atlas page {i + 1}/{len(pages)} drawn: {page.title or poster.city}")
+        c.showOutline()
+        c.save()
+    logging.info(f"Atlas of {len(pages)} pages written to {out_path}")
+    return out_path
+
+
+def _ring_operators(ring: list[float]) -> str:
+    """
+    PDF path operators of a closed subpath through the flat x, y list of a ring. Formatted in bulk,
+    as building a reportlab path point by point dominates the drawing time of long coastlines.
+    """
+    return ("%.2f %.2f m\n" + "%.2f %.2f l\n" * (len(ring) // 2 - 1) + "h\n") % tuple(ring[:len(ring) // 2 * 2])
+
+
+def fill_even_odd(image: Image.Image, rings: list[list[float]], fill: tuple[int, ...]):
+    """
+    Raster counterpart of the f* water paths: fills the flat x, y lists of the rings of one body with the
+    even-odd rule, so that islands stay holes and show what is below them. Every ring is rasterized
+    only within its bounding box on the image.
+    """
+    boxes = []
+    for ring in rings:
+        if len(ring) <= 4:
+            continue
+        points = np.asarray(ring, dtype=np.float64).reshape(-1, 2)
+        lo = np.maximum(np.floor(points.min(axis=0)), 0).astype(int)
+        hi = np.minimum(np.ceil(points.max(axis=0)) + 1, image.size).astype(int)
+        if (hi > lo).all():
+            boxes.append((points, lo, hi))
+    if not boxes:
+        return
+    left, top = np.min([lo for _, lo, _ in boxes], axis=0)
+    right, bottom = np.max([hi for _, _, hi in boxes], axis=0)
+    parity = np.zeros((bottom - top, right - left), dtype=bool)
+    for points, lo, hi in boxes:
+        mask = Image.new("1", tuple((hi - lo).tolist()), 0)
+        ImageDraw.Draw(mask).polygon((points - lo).ravel().tolist(), fill=1)
+        parity[lo[1] - top:hi[1] - top, lo[0] - left:hi[0] - left] ^= np.asarray(mask)
+    image.paste(fill, (int(left), int(top), int(right), int(bottom)), mask=Image.fromarray(parity))
+
+
 def to_simple_gtfs_type(route_type: int):
     if 0 <= route_type <= 12:
         return route_type
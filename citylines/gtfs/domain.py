@@ -1,7 +1,7 @@
 import math
 from dataclasses import dataclass
 
-from geopy.distance import distance
+import numpy as np
 
 
 @dataclass(frozen=True)
@@ -60,6 +60,9 @@ class BoundingBox:
 
     @staticmethod
     def from_center(center_p: Point, max_dist: MaxDistance, render_area: RenderArea) -> 'BoundingBox':
+        # geopy loads all of its geocoders and requests on import
+        from geopy.distance import distance
+
         center = (center_p.lat, center_p.lon)
 
         # Calculate the points north, south, east, and west of the center
@@ -93,3 +96,14 @@ class SegmentsDataset:
     segments: list[dict]
     max_trips_per_seg: int
     min_trips_per_seg: int
+
+
+@dataclass(frozen=True)
+class ShapeTrips:
+    shape_id: str
+    lats: np.ndarray
+    lons: np.ndarray
+    # simplified route type
+    route_type: int
+    # trips per hour with hourly trip weights
+    trips: int | np.ndarray
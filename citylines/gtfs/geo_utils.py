@@ -1,37 +1,70 @@
-import math
+from typing import NamedTuple
 
-from citylines.gtfs.domain import Point, MaxDistance
+import numpy as np
 
+from citylines.gtfs.domain import BoundingBox
 
-def _get_distance_from_lat_lon_in_km(point1: Point, point2: Point):
-    earth_r = 6371
-    d_lat = deg2rad(point2.lat - point1.lat)
-    d_lon = deg2rad(point2.lon - point1.lon)
-    a = math.sin(d_lat / 2) * math.sin(d_lat / 2) + \
-        math.cos(deg2rad(point1.lat)) * math.cos(deg2rad(point2.lat)) * \
-        math.sin(d_lon / 2) * math.sin(d_lon / 2)
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return earth_r * c
 
+class Window(NamedTuple):
+    left: float
+    right: float
+    top: float
+    bottom: float
 
-def deg2rad(deg):
-    return deg * (math.pi / 180)
+    @staticmethod
+    def from_bbox(bbox: BoundingBox) -> 'Window':
+        return Window(bbox.left, bbox.right, bbox.top, bbox.bottom)
 
 
-def _get_bearing(point1: Point, point2: Point):
-    d_lon = deg2rad(point2.lon - point1.lon)
-    y = math.sin(d_lon) * math.cos(deg2rad(point2.lat))
-    x = math.cos(deg2rad(point1.lat)) * math.sin(deg2rad(point2.lat)) - \
-        math.sin(deg2rad(point1.lat)) * math.cos(deg2rad(point2.lat)) * math.cos(d_lon)
-    return abs(math.atan2(y, x))
+def clip_polyline(lats: np.ndarray, lons: np.ndarray, window: Window) -> list[np.ndarray]:
+    """
+    Clips a polyline against a lat/lon window (Liang-Barsky, vectorized over all its edges).
 
+    Edges crossing the window border are cut at the entry and exit points, and a polyline
+    that leaves the window and comes back is split into several pieces.
+    :return: list of (n, 2) arrays of (lat, lon) points
+    """
+    if len(lats) == 0:
+        return []
+    # cheap reject/accept on the bounding box of the whole polyline
+    if lons.min() > window.right or lons.max() < window.left or \
+            lats.min() > window.top or lats.max() < window.bottom:
+        return []
+    points = np.stack([lats, lons], axis=1)
+    if lons.min() >= window.left and lons.max() <= window.right and \
+            lats.min() >= window.bottom and lats.max() <= window.top:
+        return [points]
+    if len(points) == 1:
+        return []
 
-def is_allowed_point(point1: Point, point2: Point, max_dist: MaxDistance):
-    brng = _get_bearing(point1, point2)
-    dist = _get_distance_from_lat_lon_in_km(point1, point2)
+    start, delta = points[:-1], np.diff(points, axis=0)
+    t0 = np.zeros(len(delta))
+    t1 = np.ones(len(delta))
+    visible = np.ones(len(delta), dtype=bool)
+    for p, q in ((-delta[:, 1], start[:, 1] - window.left), (delta[:, 1], window.right - start[:, 1]),
+                 (-delta[:, 0], start[:, 0] - window.bottom), (delta[:, 0], window.top - start[:, 0])):
+        # edges parallel to a window border and outside of it
+        visible &= ~((p == 0) & (q < 0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = q / p
+        t0 = np.where(p < 0, np.maximum(t0, r), t0)
+        t1 = np.where(p > 0, np.minimum(t1, r), t1)
+    visible &= t0 <= t1
 
-    if max_dist.max_angle < brng < math.pi - max_dist.max_angle:
-        max_allowed_dist = max_dist.x / abs(math.sin(brng))
-    else:
-        max_allowed_dist = max_dist.y / abs(math.sin(math.pi / 2 - brng))
-    return dist <= max_allowed_dist
+    # an edge continues the current piece if the previous edge is visible up to the shared vertex
+    continues = np.zeros(len(delta), dtype=bool)
+    continues[1:] = visible[:-1] & (t1[:-1] == 1) & (t0[1:] == 0)
+    starts = visible & ~continues
+
+    idx = np.flatnonzero(visible)
+    # the bounding box overlaps the window, but no edge does, e.g. a polyline around one of its corners
+    if not len(idx):
+        return []
+    entry = start[idx] + t0[idx, None] * delta[idx]
+    exit_ = start[idx] + t1[idx, None] * delta[idx]
+    # every visible edge contributes its exit point, edges starting a piece also their entry point
+    keep = np.stack([starts[idx], np.ones(len(idx), dtype=bool)], axis=1).ravel()
+    clipped = np.stack([entry, exit_], axis=1).reshape(-1, 2)[keep]
+    piece_starts = np.flatnonzero(np.stack([starts[idx], np.zeros(len(idx), dtype=bool)], axis=1).ravel()[keep])
+    # edges that only touch a window corner leave degenerate pieces
+    return [piece for piece in np.split(clipped, piece_starts[1:]) if (piece != piece[0]).any()]
@@ -1,19 +1,35 @@
+import dataclasses
+import hashlib
 import logging
 import math
+import zipfile
+from array import array
 from collections import defaultdict
 from dataclasses import dataclass
+from itertools import groupby, chain
+from operator import itemgetter
+from pathlib import Path
 from typing import Iterable, Tuple
 
 import csv
 
-from citylines.gtfs.domain import Point, SegmentsDataset, BoundingBox, MaxDistance
-from citylines.gtfs.geo_utils import is_allowed_point
+import numpy as np
+
+from citylines.gtfs.domain import SegmentsDataset, BoundingBox, ShapeTrips
+from citylines.gtfs.geo_utils import Window, clip_polyline
+from citylines.gtfs.service_calendar import ServiceIndex, TripWeights, WEEKDAYS
+
+METERS_PER_DEGREE = 111_320
 
 
 @dataclass(frozen=True)
 class GTFSDataset:
     gtfs_folder_path: str
 
+    @property
+    def gtfs_folder_paths(self) -> list[str]:
+        return [self.gtfs_folder_path]
+
     @staticmethod
     def _get_file_encoding(file_path: str) -> str:
         with open(file_path, 'rb') as file:
@@ -36,9 +52,12 @@ class GTFSDataset:
         with open(trips_path, 'r', newline='', encoding=self._get_file_encoding(trips_path)) as file:
             reader = csv.DictReader(file)
             for row in reader:
-                shape_id = row["shape_id"]
+                trip_id = row["trip_id"]
+                # shape_id is optional in GTFS, trips without it fall back to stop_times.txt geometry
+                shape_id = row.get("shape_id") or ""
                 route_id = row["route_id"]
-                yield shape_id, route_id
+                service_id = row["service_id"]
+                yield trip_id, shape_id, route_id, service_id
 
     def _parse_shapes(self) -> Iterable:
         shapes_path = f"{self.gtfs_folder_path}/shapes.txt"
@@ -51,6 +70,54 @@ class GTFSDataset:
                 shape_pt_sequence = row["shape_pt_sequence"]
                 yield shape_id, shape_pt_lat, shape_pt_lon, shape_pt_sequence, row
 
+    def _parse_stops(self) -> Iterable:
+        stops_path = f"{self.gtfs_folder_path}/stops.txt"
+        with open(stops_path, 'r', newline='', encoding=self._get_file_encoding(stops_path)) as file:
+            reader = csv.DictReader(file)
+            for row in reader:
+                stop_lat = row.get("stop_lat")
+                stop_lon = row.get("stop_lon")
+                # generic nodes and boarding areas may come without coordinates
+                if not stop_lat or not stop_lon:
+                    continue
+                yield row["stop_id"], stop_lat, stop_lon
+
+    def _parse_stop_times(self) -> Iterable:
+        stop_times_path = f"{self.gtfs_folder_path}/stop_times.txt"
+        with open(stop_times_path, 'r', newline='', encoding=self._get_file_encoding(stop_times_path)) as file:
+            # stop_times.txt is by far the largest file of a feed, plain csv.reader avoids a dict per row
+            reader = csv.reader(file)
+            header = next(reader)
+            trip_idx = header.index("trip_id")
+            stop_idx = header.index("stop_id")
+            seq_idx = header.index("stop_sequence")
+            departure_idx = header.index("departure_time")
+            for row in reader:
+                yield row[trip_idx], row[stop_idx], row[seq_idx], row[departure_idx]
+
+    def _parse_calendar(self) -> Iterable:
+        calendar_path = f"{self.gtfs_folder_path}/calendar.txt"
+        if not self._has_file("calendar.txt"):
+            return
+        with open(calendar_path, 'r', newline='', encoding=self._get_file_encoding(calendar_path)) as file:
+            reader = csv.DictReader(file)
+            for row in reader:
+                weekday_flags = [row[weekday] == "1" for weekday in WEEKDAYS]
+                yield row["service_id"], weekday_flags, row["start_date"], row["end_date"]
+
+    def _parse_calendar_dates(self) -> Iterable:
+        calendar_dates_path = f"{self.gtfs_folder_path}/calendar_dates.txt"
+        if not self._has_file("calendar_dates.txt"):
+            return
+        with open(calendar_dates_path, 'r', newline='',
+                  encoding=self._get_file_encoding(calendar_dates_path)) as file:
+            reader = csv.DictReader(file)
+            for row in reader:
+                yield row["service_id"], row["date"], row["exception_type"]
+
+    def _has_file(self, file_name: str) -> bool:
+        return Path(self.gtfs_folder_path, file_name).exists()
+
     def _get_route_id_types(self) -> dict:
         logging.debug("Starting route types iteration...")
         route_id_types = {}
@@ -60,42 +127,306 @@ class GTFSDataset:
         logging.debug(f"Total routes: {len(route_id_types)}")
         return route_id_types
 
-    def _get_trips_and_routes(self) -> Tuple[dict, dict]:
+    def _get_trips_and_routes(self, shape_ids: set, trip_weights: TripWeights | None,
+                              trip_shapes: dict | None = None) -> Tuple[dict, dict, dict]:
+        """
+        :param trip_shapes: filled with trip_id -> shape_id of the trips with a shape
+        """
         route_id_types = self._get_route_id_types()
         route_types = {}
         # count the trips on a certain id
         trips_on_a_shape = defaultdict(lambda: 0)
+        # trips without a usable shape, their geometry is rebuilt from stop_times.txt
+        unshaped_trips = {}
 
         logging.debug("Starting trip iteration...")
 
-        for shape_id, route_id in self._parse_trips():
-            trips_on_a_shape[shape_id] += 1
+        for trip_id, shape_id, route_id, _ in self._parse_trips():
+            weight = 1 if trip_weights is None else trip_weights.get(trip_id)
+            # hourly weights are vectors
+            if trip_weights is not None and not np.any(weight):
+                continue
             route_type = route_id_types[route_id]
+            if shape_id not in shape_ids:
+                unshaped_trips[trip_id] = (route_type, weight)
+                continue
+            trips_on_a_shape[shape_id] += weight
+            if trip_shapes is not None:
+                trip_shapes[trip_id] = shape_id
             if shape_id not in route_types:
                 route_types[shape_id] = route_type
 
         logging.debug("Finished trip iteration")
-        return route_types, trips_on_a_shape
+        logging.debug(f"Trips without shapes: {len(unshaped_trips)}")
+        return route_types, trips_on_a_shape, unshaped_trips
+
+    def _scan_shape_rows(self) -> Tuple[list[str], dict] | None:
+        """
+        Splits shapes.txt into the rows of every shape without parsing them, a pass over the bytes of the file.
+        Returns the header and shape_id -> (row hash, rows). The hash covers the header, so that the same rows
+        under other columns differ. Files with quoted fields return None, they need the csv parser.
+        """
+        data = Path(self.gtfs_folder_path, "shapes.txt").read_bytes()
+        if data.startswith(b'\xef\xbb\xbf'):
+            data = data[3:]
+        if b'"' in data or b"\n" not in data:
+            return None
+        if not data.endswith(b"\n"):
+            data += b"\n"
+        header = data[:data.index(b"\n")].rstrip(b"\r")
+        header_fields = header.decode().split(",")
+        if "shape_id" not in header_fields:
+            return None
+        id_column = header_fields.index("shape_id")
+
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        newlines = np.flatnonzero(buffer == ord("\n"))
+        line_starts, line_ends = newlines[:-1] + 1, newlines[1:]
+        # line ends without the carriage return of CRLF files
+        line_ends = line_ends - (buffer[line_ends - 1] == ord("\r"))
+        non_empty = line_ends > line_starts
+        line_starts, line_ends = line_starts[non_empty], line_ends[non_empty]
+        if not len(line_starts):
+            return header_fields, {}
+
+        # shape_id runs from the comma before its column to the comma after it, or to the end of the line
+        commas = np.append(np.flatnonzero(buffer == ord(",")), len(buffer))
+        first_comma = np.searchsorted(commas, line_starts)
+        if id_column > 0:
+            id_starts = commas[np.minimum(first_comma + id_column - 1, len(commas) - 1)] + 1
+        else:
+            id_starts = line_starts
+        id_ends = np.minimum(commas[np.minimum(first_comma + id_column, len(commas) - 1)], line_ends)
+        if (id_starts > line_ends).any():
+            return None
+        lengths = id_ends - id_starts
+
+        # rows of one shape are usually consecutive, a new run starts where the shape_id changes
+        same = lengths[1:] == lengths[:-1]
+        for offset in range(int(lengths.max())):
+            compared = same & (offset < lengths[1:])
+            same[compared] = buffer[id_starts[1:][compared] + offset] == buffer[id_starts[:-1][compared] + offset]
+        run_starts = np.append(0, np.flatnonzero(~same) + 1)
+        run_ends = np.append(run_starts[1:], len(line_starts)) - 1
+
+        shape_rows = defaultdict(list)
+        for first, last in zip(run_starts.tolist(), run_ends.tolist()):
+            shape_id = data[id_starts[first]:id_ends[first]].decode()
+            shape_rows[shape_id].append(data[line_starts[first]:line_ends[last]])
+        result = {}
+        for shape_id, rows in shape_rows.items():
+            row_hash = hashlib.blake2b(header, digest_size=16)
+            for block in rows:
+                row_hash.update(block)
+            result[shape_id] = (row_hash.hexdigest(), rows)
+        return header_fields, result
 
-    def _get_sequences(self, center_point: Point, max_dist: MaxDistance) -> dict:
-        logging.debug("Starting shape iteration...")
-        sequences = defaultdict(dict)
-        for shape_id, shape_pt_lat, shape_pt_lon, shape_pt_sequence, shape_row in self._parse_shapes():
-            # check out of boundaries
-            if is_allowed_point(Point(float(shape_pt_lat), float(shape_pt_lon)), center_point, max_dist):
-                sequences[shape_id][shape_pt_sequence] = shape_row
+    @staticmethod
+    def _shape_geometry(seqs: array, lats: array, lons: array, window: Window | None) -> Tuple | None:
+        lats, lons = np.frombuffer(lats), np.frombuffer(lons)
+        # cheap bbox reject before any per-point work
+        if window is not None and (lons.min() > window.right or lons.max() < window.left or
+                                   lats.min() > window.top or lats.max() < window.bottom):
+            return None
+        # sort sequences as some GTFS datasets have them unsorted (e.g., Wroclaw)
+        order = np.argsort(np.frombuffer(seqs, dtype=np.int64), kind='stable')
+        return lats[order], lons[order]
+
+    def _get_cached_shapes(self, window: Window | None, shape_cache: 'ShapeCache') -> Tuple[dict, set] | None:
+        """
+        As _get_shapes, but only the shapes whose rows are not in the cache are parsed.
+        """
+        scanned = self._scan_shape_rows()
+        if scanned is None:
+            return None
+        header_fields, shape_rows = scanned
+        lat_idx, lon_idx, seq_idx = (header_fields.index(column)
+                                     for column in ("shape_pt_lat", "shape_pt_lon", "shape_pt_sequence"))
+        shapes = {}
+        parsed = 0
+        for shape_id, (row_hash, rows) in shape_rows.items():
+            if row_hash in shape_cache:
+                geometry = shape_cache.get(row_hash)
+            else:
+                seqs, lats, lons = array('q'), array('d'), array('d')
+                for row in csv.reader(b"\n".join(rows).decode().splitlines()):
+                    seqs.append(int(row[seq_idx]))
+                    lats.append(float(row[lat_idx]))
+                    lons.append(float(row[lon_idx]))
+                geometry = self._shape_geometry(seqs, lats, lons, window)
+                parsed += 1
+            shape_cache.add(row_hash, geometry)
+            if geometry is not None:
+                shapes[shape_id] = geometry
+        logging.debug(f"Shapes parsed: {parsed}, taken from the cache: {len(shape_rows) - parsed}")
+        logging.debug(f"Shapes in the window: {len(shapes)} of {len(shape_rows)}")
+        return shapes, set(shape_rows)
+
+    def _get_shapes(self, window: Window | None, shape_cache: 'ShapeCache | None' = None) -> Tuple[dict, set]:
+        """
+        Collects the points of every shape into compact arrays, sorted by shape_pt_sequence.
+        Returns shapes that intersect the window (all shapes without a window) as shape_id -> (lats, lons),
+        and ids of all shapes.
+        :param shape_cache: shapes of a previous run with the same window, filled with the shapes of this one
+        """
+        shapes = {}
+        shape_ids = set()
+        if not self._has_file("shapes.txt"):
+            logging.debug("No shapes.txt in the feed, all geometry comes from stop_times.txt")
+            return shapes, shape_ids
+        if shape_cache is not None and shape_cache.window == window:
+            cached = self._get_cached_shapes(window, shape_cache)
+            if cached is not None:
+                return cached
 
+        logging.debug("Starting shape iteration...")
+        shape_points = defaultdict(lambda: (array('q'), array('d'), array('d')))
+        for shape_id, shape_pt_lat, shape_pt_lon, shape_pt_sequence, _ in self._parse_shapes():
+            seqs, lats, lons = shape_points[shape_id]
+            seqs.append(int(shape_pt_sequence))
+            lats.append(float(shape_pt_lat))
+            lons.append(float(shape_pt_lon))
         logging.debug("Finished shape iteration")
-        return sequences
 
-    def compute_segments(self, center: Point, max_dist: MaxDistance) -> SegmentsDataset:
-        route_types, trips_on_a_shape = self._get_trips_and_routes()
-        sequences = self._get_sequences(center, max_dist)
-        segments = []
-        max_trips, min_trips = 0, math.inf
-        min_left, max_right, max_top, min_bottom = math.inf, 0, 0, math.inf
+        for shape_id, (seqs, lats, lons) in shape_points.items():
+            shape_ids.add(shape_id)
+            geometry = self._shape_geometry(seqs, lats, lons, window)
+            if geometry is not None:
+                shapes[shape_id] = geometry
+        logging.debug(f"Shapes in the window: {len(shapes)} of {len(shape_ids)}")
+        return shapes, shape_ids
+
+    def _get_stop_index(self) -> Tuple[dict, array, array]:
+        """
+        Compact stop coordinate index: stop_id -> position in the lat/lon arrays.
+        """
+        logging.debug("Starting stop iteration...")
+        stop_positions = {}
+        lats, lons = array('d'), array('d')
+        for stop_id, stop_lat, stop_lon in self._parse_stops():
+            stop_positions[stop_id] = len(lats)
+            lats.append(float(stop_lat))
+            lons.append(float(stop_lon))
+        logging.debug(f"Total stops: {len(stop_positions)}")
+        return stop_positions, lats, lons
+
+    def _get_stop_patterns(self, unshaped_trips: dict, stop_positions: dict,
+                           trip_patterns: dict | None = None) -> dict:
+        """
+        Streams stop_times.txt grouped by trip and de-duplicates identical stop sequences of the same route type.
+        Returns a dict of (route_type, stop position tuple) -> trips.
+        :param trip_patterns: filled with trip_id -> (route_type, stop position tuple)
+        """
+        logging.debug("Starting stop times iteration...")
+        # (route_type, pattern) -> [trips, pattern], the pattern is kept in the value to intern equal tuples
+        patterns = {}
+        # trip_id -> (pattern, first stop_sequence, last stop_sequence), to merge trips split across the file
+        seen_trips = {}
+
+        for trip_id, stop_times in groupby(self._parse_stop_times(), key=itemgetter(0)):
+            if trip_id not in unshaped_trips:
+                continue
+            route_type, weight = unshaped_trips[trip_id]
+            stops = sorted((int(stop_sequence), stop_positions[stop_id])
+                           for _, stop_id, stop_sequence, _ in stop_times if stop_id in stop_positions)
+            if not stops:
+                continue
 
-        for shape_id, shape_sequences in sequences.items():
+            pattern = tuple(pos for _, pos in stops)
+            first_seq, last_seq = stops[0][0], stops[-1][0]
+            if trip_id in seen_trips:
+                # stop_times.txt is not grouped by trip_id, glue this chunk to the previous one
+                prev_pattern, prev_first_seq, prev_last_seq = seen_trips[trip_id]
+                if first_seq > prev_last_seq:
+                    pattern, first_seq = prev_pattern + pattern, prev_first_seq
+                elif last_seq < prev_first_seq:
+                    pattern, last_seq = pattern + prev_pattern, prev_last_seq
+                else:
+                    logging.warning(f"Overlapping stop sequences for trip {trip_id}, ignoring the extra stop times")
+                    continue
+
+            # a bus and a tram serving the same stops are drawn as separate lines
+            pattern_info = patterns.get((route_type, pattern))
+            if pattern_info is None:
+                pattern_info = patterns[(route_type, pattern)] = [0, pattern]
+            # trips of the same pattern share its canonical tuple instead of keeping their own copy
+            seen_trips[trip_id] = (pattern_info[1], first_seq, last_seq)
+
+        # trips are counted once their chunks are glued, adding and removing the weights of partial patterns
+        # would leave rounding residues on hourly weights
+        for trip_id, (pattern, _, _) in seen_trips.items():
+            route_type, weight = unshaped_trips[trip_id]
+            patterns[(route_type, pattern)][0] += weight
+
+        if trip_patterns is not None:
+            trip_patterns.update((trip_id, (unshaped_trips[trip_id][0], pattern))
+                                 for trip_id, (pattern, _, _) in seen_trips.items())
+        logging.debug("Finished stop times iteration")
+        logging.debug(f"Distinct stop sequences: {len(patterns)}")
+        return {key: trips for key, (trips, _) in patterns.items() if np.any(trips > 0)}
+
+    def _add_stop_shapes(self, unshaped_trips: dict, route_types: dict, trips_on_a_shape: dict, shapes: dict,
+                         trip_shapes: dict | None = None):
+        """
+        Fallback for trips without shapes: stop-to-stop polylines are added as pseudo-shapes,
+        so that they go through the same trip count and route type pipeline.
+        :param trip_shapes: filled with trip_id -> pseudo-shape id of the trips without a shape
+        """
+        stop_positions, lats, lons = self._get_stop_index()
+        trip_patterns = {} if trip_shapes is not None else None
+        patterns = self._get_stop_patterns(unshaped_trips, stop_positions, trip_patterns)
+        lats, lons = np.frombuffer(lats), np.frombuffer(lons)
+        pattern_shape_ids = {}
+
+        for (route_type, pattern), trips_n in patterns.items():
+            positions = np.array(pattern)
+            pattern_lats, pattern_lons = lats[positions], lons[positions]
+            # ids follow the stop coordinates, so that changes to other patterns do not renumber them
+            digest = hashlib.blake2b(pattern_lats.tobytes() + pattern_lons.tobytes(), digest_size=8).hexdigest()
+            shape_id = f"stops:{route_type}:{digest}"
+            pattern_shape_ids[(route_type, pattern)] = shape_id
+            if shape_id in shapes:
+                # distinct stops at the same coordinates draw the same line
+                trips_on_a_shape[shape_id] += trips_n
+                continue
+            route_types[shape_id] = route_type
+            trips_on_a_shape[shape_id] = trips_n
+            shapes[shape_id] = (pattern_lats, pattern_lons)
+
+        if trip_shapes is not None:
+            trip_shapes.update((trip_id, pattern_shape_ids[key]) for trip_id, key in trip_patterns.items()
+                               if key in pattern_shape_ids)
+
+    def service_index(self, with_hours: bool = False) -> ServiceIndex:
+        """
+        Builds the service-day index of the feed, optionally with first departure hours of every trip
+        (a full pass over stop_times.txt).
+        """
+        logging.debug("Building service index...")
+        stop_time_rows = None
+        if with_hours:
+            stop_time_rows = ((trip_id, stop_sequence, departure_time)
+                              for trip_id, _, stop_sequence, departure_time in self._parse_stop_times())
+        return ServiceIndex.build(self._parse_calendar(), self._parse_calendar_dates(),
+                                  ((trip_id, service_id) for trip_id, _, _, service_id in self._parse_trips()),
+                                  stop_time_rows)
+
+    def collect_shapes(self, bbox: BoundingBox | None, trip_weights: TripWeights | None = None,
+                       shape_cache: 'ShapeCache | None' = None) -> list[ShapeTrips]:
+        """
+        Shapes (including stop_times.txt pseudo-shapes) intersecting the bounding box, with their trip counts.
+        :param bbox: None collects all shapes of the feed
+        :param trip_weights: optional weights from a service index, to count only trips of a service window.
+        With hourly weights, the trips of every shape are a vector of (fractional) trips per hour.
+        :param shape_cache: parsed shapes.txt shapes of a previous run, see ShapeCache
+        """
+        shapes, shape_ids = self._get_shapes(Window.from_bbox(bbox) if bbox is not None else None, shape_cache)
+        route_types, trips_on_a_shape, unshaped_trips = self._get_trips_and_routes(shape_ids, trip_weights)
+        if unshaped_trips:
+            self._add_stop_shapes(unshaped_trips, route_types, trips_on_a_shape, shapes)
+        result = []
+
+        for shape_id, (lats, lons) in shapes.items():
             route_type = get_route_type_for_shape_id(shape_id, route_types)
 
             if route_type is None:
@@ -103,56 +434,326 @@ class GTFSDataset:
             if shape_id not in trips_on_a_shape:
                 continue
 
-            trips_n = trips_on_a_shape[shape_id]
+            if isinstance(trips_on_a_shape[shape_id], np.ndarray):
+                trips_n = trips_on_a_shape[shape_id]
+                if not trips_n.any():
+                    continue
+            else:
+                # weekday averages give fractional trip counts
+                trips_n = round(trips_on_a_shape[shape_id])
+                if trips_n <= 0:
+                    continue
+
+            result.append(ShapeTrips(shape_id, lats, lons, route_type, trips_n))
+        return result
+
+    def shape_trip_index(self) -> 'ShapeTripIndex':
+        """
+        All shapes of the feed (including stop_times.txt pseudo-shapes) with the shape of every trip.
+        """
+        shapes, shape_ids = self._get_shapes(None)
+        trip_shapes = {}
+        route_types, trips_on_a_shape, unshaped_trips = self._get_trips_and_routes(shape_ids, None, trip_shapes)
+        if unshaped_trips:
+            self._add_stop_shapes(unshaped_trips, route_types, trips_on_a_shape, shapes, trip_shapes)
+        return ShapeTripIndex.build(shapes, route_types, trip_shapes)
+
+    def compute_segments(self, bbox: BoundingBox, trip_weights: TripWeights | None = None) -> SegmentsDataset:
+        """
+        :param bbox: shapes are clipped to this bounding box, and split where they leave it and come back
+        :param trip_weights: optional weights from a service index, to count only trips of a service window
+        """
+        return compute_segments(self.collect_shapes(bbox, trip_weights), bbox)
+
+    @staticmethod
+    def from_path(gtfs_folder: str) -> 'GTFSDataset':
+        for required_file in ("routes.txt", "trips.txt"):
+            if not Path(gtfs_folder, required_file).exists():
+                raise ValueError(f"{gtfs_folder}/{required_file} does not exist")
+        # geometry comes from shapes.txt, or from stop_times.txt + stops.txt as a fallback
+        has_shapes = Path(gtfs_folder, "shapes.txt").exists()
+        has_stops = all(Path(gtfs_folder, f).exists() for f in ("stop_times.txt", "stops.txt"))
+        if not has_shapes and not has_stops:
+            raise ValueError(f"{gtfs_folder} has neither shapes.txt nor stop_times.txt and stops.txt")
+        return GTFSDataset(gtfs_folder)
+
 
-            if trips_n > max_trips:
-                max_trips = trips_n
+@dataclass(frozen=True)
+class MultiFeedDataset:
+    """
+    Several feeds covering one area, e.g. the agencies on both sides of a border.
+
+    Ids are namespaced with the feed id ("{feed_id}:{id}"). Shapes that are geometrically identical
+    across feeds, up to the quantization grid, are drawn once with their trips combined.
+    """
+    feeds: tuple[GTFSDataset, ...]
+    feed_ids: tuple[str, ...]
+    # grid size of the geometry hash, shapes closer than that are considered identical
+    grid_m: float = 10
+
+    @property
+    def gtfs_folder_paths(self) -> list[str]:
+        return [feed.gtfs_folder_path for feed in self.feeds]
+
+    def service_index(self, with_hours: bool = False) -> ServiceIndex:
+        """
+        Service index over all feeds, with namespaced service and trip ids.
+        """
+        def namespaced(feed_id: str, rows: Iterable, n_ids: int) -> Iterable:
+            for row in rows:
+                yield tuple(f"{feed_id}:{value}" for value in row[:n_ids]) + tuple(row[n_ids:])
+
+        calendar_rows, calendar_date_rows, trip_rows, stop_time_rows = [], [], [], []
+        for feed_id, feed in zip(self.feed_ids, self.feeds):
+            calendar_rows.append(namespaced(feed_id, feed._parse_calendar(), 1))
+            calendar_date_rows.append(namespaced(feed_id, feed._parse_calendar_dates(), 1))
+            trip_rows.append(namespaced(feed_id, ((trip_id, service_id)
+                                                  for trip_id, _, _, service_id in feed._parse_trips()), 2))
+            if with_hours:
+                stop_time_rows.append(namespaced(feed_id, ((trip_id, stop_sequence, departure_time)
+                                                           for trip_id, _, stop_sequence, departure_time
+                                                           in feed._parse_stop_times()), 1))
+        return ServiceIndex.build(chain.from_iterable(calendar_rows), chain.from_iterable(calendar_date_rows),
+                                  chain.from_iterable(trip_rows),
+                                  chain.from_iterable(stop_time_rows) if with_hours else None)
+
+    def _geometry_hash(self, shape: ShapeTrips, center_lat: float) -> bytes:
+        lat_step = self.grid_m / METERS_PER_DEGREE
+        lon_step = lat_step / math.cos(math.radians(center_lat))
+        grid = np.stack([np.round(shape.lats / lat_step), np.round(shape.lons / lon_step)], axis=1).astype(np.int64)
+        # near-identical shapes may have a different number of points on the same cell
+        keep = np.ones(len(grid), dtype=bool)
+        keep[1:] = (grid[1:] != grid[:-1]).any(axis=1)
+        return hashlib.blake2b(grid[keep].tobytes(), digest_size=16).digest()
+
+    def collect_shapes(self, bbox: BoundingBox | None, trip_weights: TripWeights | None = None,
+                       shape_cache: 'ShapeCache | None' = None) -> list[ShapeTrips]:
+        """
+        :param bbox: None collects all shapes of the feeds
+        :param trip_weights: optional weights from the service index of this multi-feed dataset
+        :param shape_cache: parsed shapes of a previous run, shared by all feeds as it is keyed by content
+        """
+        # the geometry hash grid is finer in meters east-west away from the equator without a bbox
+        center_lat = bbox.center.lat if bbox is not None else 0
+        result = []
+        # geometry hash -> position in result, of shapes from the feeds before the current one
+        known_shapes = {}
+        merged = 0
+
+        for feed_id, feed in zip(self.feed_ids, self.feeds):
+            feed_shapes = {}
+            feed_weights = trip_weights.for_feed(feed_id) if trip_weights is not None else None
+            for shape in feed.collect_shapes(bbox, feed_weights, shape_cache):
+                geometry_hash = self._geometry_hash(shape, center_lat)
+                pos = known_shapes.get(geometry_hash)
+                if pos is not None:
+                    known = result[pos]
+                    result[pos] = dataclasses.replace(known, trips=known.trips + shape.trips)
+                    merged += 1
+                    continue
+                # duplicates within one feed are left as they are, as with a single feed
+                feed_shapes.setdefault(geometry_hash, len(result))
+                result.append(dataclasses.replace(shape, shape_id=f"{feed_id}:{shape.shape_id}"))
+            known_shapes.update(feed_shapes)
+
+        logging.debug(f"Shapes from {len(self.feeds)} feeds: {len(result)}, merged across feeds: {merged}")
+        return result
+
+    def shape_trip_index(self) -> 'ShapeTripIndex':
+        """
+        Shape trip index over all feeds, with namespaced shape and trip ids and identical shapes combined.
+        """
+        shapes = []
+        trip_ids = []
+        trip_shapes = []
+        known_shapes = {}
+
+        for feed_id, feed in zip(self.feed_ids, self.feeds):
+            index = feed.shape_trip_index()
+            feed_shapes = {}
+            # position of every shape of this feed in the combined index
+            positions = np.empty(len(index.shapes), dtype=np.int64)
+            for i, shape in enumerate(index.shapes):
+                geometry_hash = self._geometry_hash(shape, 0)
+                pos = known_shapes.get(geometry_hash)
+                if pos is None:
+                    pos = len(shapes)
+                    feed_shapes.setdefault(geometry_hash, pos)
+                    shapes.append(dataclasses.replace(shape, shape_id=f"{feed_id}:{shape.shape_id}"))
+                positions[i] = pos
+            known_shapes.update(feed_shapes)
+            trip_ids.extend(f"{feed_id}:{trip_id}" for trip_id in index.trip_ids)
+            trip_shapes.append(positions[index.trip_shapes])
+
+        return ShapeTripIndex(shapes, trip_ids, np.concatenate(trip_shapes))
+
+    def compute_segments(self, bbox: BoundingBox, trip_weights: TripWeights | None = None) -> SegmentsDataset:
+        return compute_segments(self.collect_shapes(bbox, trip_weights), bbox)
 
-            if trips_n < min_trips:
-                min_trips = trips_n
+    @staticmethod
+    def from_paths(gtfs_folders: list[str], grid_m: float = 10) -> 'MultiFeedDataset':
+        """
+        Feed ids are the feed directory names.
+        """
+        feed_ids = tuple(Path(gtfs_folder).name for gtfs_folder in gtfs_folders)
+        if len(set(feed_ids)) != len(feed_ids):
+            raise ValueError(f"Feed directory names must be unique: {', '.join(gtfs_folders)}")
+        return MultiFeedDataset(tuple(GTFSDataset.from_path(f) for f in gtfs_folders), feed_ids, grid_m)
 
-            pts = []
-            # sort sequences as some GTFS datasets have them unsorted (e.g., Wroclaw)
-            for shape in sorted(shape_sequences.values(), key=lambda s: int(s['shape_pt_sequence'])):
-                y = float(shape['shape_pt_lat'])
-                x = float(shape['shape_pt_lon'])
-                min_left = min(x, min_left)
-                min_bottom = min(y, min_bottom)
-                max_top = max(y, max_top)
-                max_right = max(x, max_right)
 
-                pts.append({'lat': shape['shape_pt_lat'], 'lon': shape['shape_pt_lon']})
+@dataclass(frozen=True)
+class ShapeTripIndex:
+    """
+    A feed parsed once for any service window: the geometry of all its shapes and the shape of every trip.
+    Trip counts of a window are a weighted sum over the trips, without reading the feed again.
+    """
+    # trips are not set, see collect_shapes
+    shapes: list[ShapeTrips]
+    trip_ids: list[str]
+    # position in shapes of every trip
+    trip_shapes: np.ndarray
 
-            if len(pts) == 0:
+    @staticmethod
+    def build(shapes: dict, route_types: dict, trip_shapes: dict) -> 'ShapeTripIndex':
+        """
+        :param shapes: shape_id -> (lats, lons)
+        :param trip_shapes: trip_id -> shape_id
+        """
+        positions = {}
+        index_shapes = []
+        for shape_id, (lats, lons) in shapes.items():
+            route_type = get_route_type_for_shape_id(shape_id, route_types)
+            if route_type is None:
                 continue
+            positions[shape_id] = len(index_shapes)
+            index_shapes.append(ShapeTrips(shape_id, lats, lons, route_type, 0))
+        trip_ids = [trip_id for trip_id, shape_id in trip_shapes.items() if shape_id in positions]
+        return ShapeTripIndex(index_shapes, trip_ids,
+                              np.array([positions[trip_shapes[trip_id]] for trip_id in trip_ids], dtype=np.int64))
+
+    def collect_shapes(self, trip_weights: TripWeights | None = None) -> list[ShapeTrips]:
+        """
+        Shapes with their trip counts, as collect_shapes of the dataset without a bounding box.
+        :param trip_weights: weights from the service index of the same dataset
+        """
+        weights = np.ones(len(self.trip_ids)) if trip_weights is None else trip_weights.take(self.trip_ids)
+        shape_trips = np.zeros((len(self.shapes),) + weights.shape[1:])
+        np.add.at(shape_trips, self.trip_shapes, weights)
+
+        result = []
+        for shape, trips in zip(self.shapes, shape_trips):
+            if trips.ndim:
+                if not trips.any():
+                    continue
+                trips_n = trips
+            else:
+                # weekday averages give fractional trip counts
+                trips_n = round(float(trips))
+                if trips_n <= 0:
+                    continue
+            result.append(dataclasses.replace(shape, trips=trips_n))
+        return result
+
+
+class ShapeCache:
+    """
+    Parsed shapes of a previous run by the hash of their rows in shapes.txt, so that the unchanged shapes
+    of an updated feed are neither parsed nor sorted again. Shapes outside of the window the cache was built
+    for are kept without their geometry, the cache is only used with the same window.
+
+    Every run adds the shapes it sees, saving the cache keeps only those.
+    """
+
+    def __init__(self, window: Window | None, previous: dict | None = None):
+        self.window = window
+        # row hash -> (lats, lons), None outside of the window
+        self._previous = previous or {}
+        self._current = {}
+
+    def __contains__(self, row_hash: str) -> bool:
+        return row_hash in self._previous
+
+    def get(self, row_hash: str) -> Tuple | None:
+        return self._previous[row_hash]
+
+    def add(self, row_hash: str, geometry: Tuple | None):
+        self._current[row_hash] = geometry
+
+    def save(self, file):
+        inside = [row_hash for row_hash, geometry in self._current.items() if geometry is not None]
+        outside = [row_hash for row_hash, geometry in self._current.items() if geometry is None]
+        geometries = [self._current[row_hash] for row_hash in inside]
+        np.savez(file, window=np.array(self.window if self.window is not None else [], dtype=np.float64),
+                 inside=np.array(inside, dtype=str), outside=np.array(outside, dtype=str),
+                 lengths=np.array([len(lats) for lats, _ in geometries], dtype=np.int64),
+                 lats=np.concatenate([lats for lats, _ in geometries] or [np.zeros(0)]),
+                 lons=np.concatenate([lons for _, lons in geometries] or [np.zeros(0)]))
 
+    @staticmethod
+    def load(path: Path, window: Window | None) -> 'ShapeCache':
+        """
+        A cache of another window is dropped, as its shapes outside of the window have no geometry.
+        """
+        try:
+            with np.load(path) as data:
+                if data["window"].tolist() != (list(window) if window is not None else []):
+                    return ShapeCache(window)
+                bounds = np.cumsum(data["lengths"])[:-1]
+                previous = dict(zip(data["inside"].tolist(), zip(np.split(data["lats"], bounds),
+                                                                  np.split(data["lons"], bounds))))
+                previous.update((row_hash, None) for row_hash in data["outside"].tolist())
+        except FileNotFoundError:
+            return ShapeCache(window)
+        except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            # the cache only saves time, all shapes are parsed again
+            logging.warning(f"Ignoring unreadable shape cache {path}: {e}")
+            return ShapeCache(window)
+        return ShapeCache(window, previous)
+
+
+def compute_segments(shapes: Iterable[ShapeTrips], bbox: BoundingBox) -> SegmentsDataset:
+    """
+    Clips shapes to the bounding box, and splits them where they leave it and come back.
+    """
+    window = Window.from_bbox(bbox)
+    segments = []
+    trip_counts = []
+
+    for shape in shapes:
+        pieces = clip_polyline(shape.lats, shape.lons, window)
+        if not pieces:
+            continue
+
+        trip_counts.append(shape.trips)
+        for piece in pieces:
             segments.append({
-                "trips": trips_n,
-                "coordinates": pts,
-                "route_type": route_type
+                "trips": shape.trips,
+                # (lat, lon) pairs
+                "coordinates": piece,
+                "route_type": shape.route_type,
+                "shape_id": shape.shape_id
             })
 
-        logging.debug("Segments created.")
+    logging.debug("Segments created.")
+    max_trips, min_trips = get_trips_range(trip_counts)
+    return SegmentsDataset(segments, max_trips, min_trips)
 
-        if max_trips == min_trips and max_trips > 0:
-            min_trips -= 1
-        if max_trips == min_trips and max_trips <= 0:
-            max_trips += 1
 
-        logging.debug(f"max trips per segment: {max_trips}")
-        logging.debug(f"min trips per segment: {min_trips}")
+def get_trips_range(trip_counts: list[int]) -> Tuple[int, int]:
+    """
+    Range of the trips per segment, never empty so that it can scale line widths. No segments give (1, 0).
+    """
+    max_trips = max(trip_counts, default=0)
+    min_trips = min(trip_counts, default=0)
 
-        return SegmentsDataset(segments, max_trips, min_trips)
+    if max_trips == min_trips and max_trips > 0:
+        min_trips -= 1
+    if max_trips == min_trips and max_trips <= 0:
+        max_trips += 1
 
-    @staticmethod
-    def from_path(gtfs_folder: str) -> 'GTFSDataset':
-        required_file = f"{gtfs_folder}/shapes.txt"
-        try:
-            with open(required_file, "r"):
-                pass
-        except IOError:
-            raise ValueError(f"{required_file} does not exist")
-        return GTFSDataset(gtfs_folder)
+    logging.debug(f"max trips per segment: {max_trips}")
+    logging.debug(f"min trips per segment: {min_trips}")
+    return max_trips, min_trips
 
 
 def get_route_type_for_shape_id(shape_id, route_types):
@@ -171,8 +772,3 @@ def get_route_type_for_shape_id(shape_id, route_types):
 
     return route_type
 
-
-def coord2px(lat: float, lng: float, bbox: BoundingBox):
-    coord_x = (lng - bbox.center.lon) * bbox.scale_factor_lon
-    coord_y = (lat - bbox.center.lat) * bbox.scale_factor_lat
-    return {'x': int(coord_x), 'y': int(coord_y)}
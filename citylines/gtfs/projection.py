@@ -0,0 +1,70 @@
+import math
+
+import numpy as np
+
+from citylines.gtfs.domain import BoundingBox
+
+EARTH_RADIUS_KM = 6371
+
+EQUIRECTANGULAR = "equirectangular"
+AZIMUTHAL_EQUIDISTANT = "aeqd"
+WEB_MERCATOR = "mercator"
+PROJECTIONS = [EQUIRECTANGULAR, AZIMUTHAL_EQUIDISTANT, WEB_MERCATOR]
+
+
+class Projection:
+    """
+    Maps coordinate arrays to poster pixels relative to the bounding box center, built once per bounding box.
+
+    The default equirectangular projection scales latitudes and longitudes independently, so that the
+    bounding box edges land on the render area edges. Azimuthal equidistant and Web Mercator
+    projections use a single scale and do not stretch wide areas.
+    """
+
+    def __init__(self, bbox: BoundingBox, kind: str = EQUIRECTANGULAR):
+        if kind not in PROJECTIONS:
+            raise ValueError(f"Unknown projection: {kind}")
+        self.bbox = bbox
+        self.kind = kind
+        self.center_lat = bbox.center.lat
+        self.center_lon = bbox.center.lon
+
+        if kind == EQUIRECTANGULAR:
+            self.scale_x = bbox.scale_factor_lon
+            self.scale_y = bbox.scale_factor_lat
+        else:
+            # the northern edge of the bounding box lands on the render area height, as with equirectangular
+            _, north_y = self._project_unscaled(np.array([bbox.top]), np.array([self.center_lon]))
+            self.scale_x = self.scale_y = bbox.render_area.height_px / north_y[0]
+
+    def _project_unscaled(self, lats: np.ndarray, lons: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        if self.kind == EQUIRECTANGULAR:
+            return lons - self.center_lon, lats - self.center_lat
+
+        lat, lon = np.radians(lats), np.radians(lons)
+        lat0, lon0 = math.radians(self.center_lat), math.radians(self.center_lon)
+        if self.kind == WEB_MERCATOR:
+            x = EARTH_RADIUS_KM * (lon - lon0)
+            y = EARTH_RADIUS_KM * (np.log(np.tan(np.pi / 4 + lat / 2)) - math.log(math.tan(math.pi / 4 + lat0 / 2)))
+            return x, y
+
+        # azimuthal equidistant: distances from the center are preserved
+        d_lon = lon - lon0
+        cos_c = math.sin(lat0) * np.sin(lat) + math.cos(lat0) * np.cos(lat) * np.cos(d_lon)
+        c = np.arccos(np.clip(cos_c, -1, 1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            k = np.where(c > 0, c / np.sin(c), 1.0)
+        x = EARTH_RADIUS_KM * k * np.cos(lat) * np.sin(d_lon)
+        y = EARTH_RADIUS_KM * k * (math.cos(lat0) * np.sin(lat) - math.sin(lat0) * np.cos(lat) * np.cos(d_lon))
+        return x, y
+
+    def project(self, lats, lons) -> np.ndarray:
+        """
+        :return: (n, 2) int32 array of pixel (x, y) pairs
+        """
+        x, y = self._project_unscaled(np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64))
+        px = np.empty((len(x), 2), dtype=np.int32)
+        # truncate towards zero like int()
+        px[:, 0] = x * self.scale_x
+        px[:, 1] = y * self.scale_y
+        return px
@@ -0,0 +1,229 @@
+import datetime
+import logging
+from dataclasses import dataclass
+from typing import Iterable
+
+import numpy as np
+
+HOURS = 24
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+
+def _parse_gtfs_date(value: str) -> datetime.date:
+    return datetime.datetime.strptime(value.strip(), "%Y%m%d").date()
+
+
+@dataclass(frozen=True)
+class ServiceWindow:
+    """
+    Selects which trips are counted: trips running on a given date, or on a typical weekday
+    (averaged over all such days of the feed period), optionally restricted to departure hours.
+    """
+    date: datetime.date | None = None
+    weekday: int | None = None  # 0 is Monday
+    hours: tuple[int, int] | None = None  # [start, end) departure hours, end < start wraps around midnight
+
+    @staticmethod
+    def parse_hours(value: str) -> tuple[int, int]:
+        """
+        Parses departure hours given as START-END, e.g. 7-9 or 22-2.
+        """
+        try:
+            start, end = map(int, value.split("-"))
+        except (AttributeError, ValueError):
+            raise ValueError(f"Hours must be given as START-END, e.g. 7-9, got {value!r}")
+        if not (0 <= start < HOURS and 0 <= end <= HOURS):
+            raise ValueError(f"Hours must be between 0 and {HOURS}, got {value!r}")
+        if start == end:
+            raise ValueError(f"Hours {value!r} select no departures, use 0-{HOURS} for the whole day")
+        return start, end
+
+    def slug(self) -> str:
+        parts = []
+        if self.date is not None:
+            parts.append(self.date.strftime("%Y%m%d"))
+        if self.weekday is not None:
+            parts.append(WEEKDAYS[self.weekday])
+        if self.hours is not None:
+            parts.append(f"{self.hours[0]}-{self.hours[1]}h")
+        return "_".join(parts) or "all"
+
+
+class TripWeights:
+    """
+    Per-trip weights for a service window, 0 for trips not running in the window.
+    Hourly weights hold a vector per trip, with the weight in the hour of its first departure.
+    """
+
+    def __init__(self, trip_positions: dict, weights: np.ndarray, prefix: str = ""):
+        self._trip_positions = trip_positions
+        self._weights = weights
+        self._prefix = prefix
+
+    @property
+    def hourly(self) -> bool:
+        return self._weights.ndim == 2
+
+    def get(self, trip_id: str) -> float | np.ndarray:
+        pos = self._trip_positions.get(self._prefix + trip_id if self._prefix else trip_id)
+        if self.hourly:
+            return np.zeros(HOURS) if pos is None else self._weights[pos].copy()
+        return 0.0 if pos is None else float(self._weights[pos])
+
+    def take(self, trip_ids: list[str]) -> np.ndarray:
+        """
+        Weights of many trips at once, in the order of trip_ids.
+        """
+        positions = np.fromiter((self._trip_positions.get(self._prefix + trip_id, -1) for trip_id in trip_ids),
+                                dtype=np.int64, count=len(trip_ids))
+        # unknown trips (-1) take the zero row at the end
+        padded = np.concatenate([self._weights, np.zeros((1,) + self._weights.shape[1:])])
+        return padded[positions]
+
+    def for_feed(self, feed_id: str) -> 'TripWeights':
+        """
+        Weights of a multi-feed index, looked up with the plain trip ids of one of its feeds.
+        """
+        return TripWeights(self._trip_positions, self._weights, prefix=f"{feed_id}:")
+
+
+class ServiceIndex:
+    """
+    Service-day index built once from calendar.txt and calendar_dates.txt.
+
+    Holds a service x day activity matrix and, per trip, its service and first departure hour,
+    so that trip weights for any date, weekday or hour window are plain array lookups.
+    """
+
+    def __init__(self, start_date: datetime.date, active: np.ndarray, trip_positions: dict,
+                 trip_services: np.ndarray, trip_hours: np.ndarray | None):
+        self.start_date = start_date
+        self.active = active
+        self.trip_positions = trip_positions
+        self.trip_services = trip_services
+        self.trip_hours = trip_hours
+
+    @property
+    def n_days(self) -> int:
+        return self.active.shape[1]
+
+    @staticmethod
+    def build(calendar_rows: Iterable, calendar_date_rows: Iterable, trip_rows: Iterable,
+              stop_time_rows: Iterable | None = None) -> 'ServiceIndex':
+        """
+        :param calendar_rows: (service_id, weekday flags, start_date, end_date) tuples from calendar.txt
+        :param calendar_date_rows: (service_id, date, exception_type) tuples from calendar_dates.txt
+        :param trip_rows: (trip_id, service_id) tuples from trips.txt
+        :param stop_time_rows: optional (trip_id, stop_sequence, departure_time) tuples from stop_times.txt,
+        needed for hour windows
+        """
+        calendar = [(service_id, flags, _parse_gtfs_date(start), _parse_gtfs_date(end))
+                    for service_id, flags, start, end in calendar_rows]
+        calendar_dates = [(service_id, _parse_gtfs_date(date), exception_type == "1")
+                          for service_id, date, exception_type in calendar_date_rows]
+
+        dates = [d for _, _, start, end in calendar for d in (start, end)] + [d for _, d, _ in calendar_dates]
+        if not dates:
+            raise ValueError("The feed has neither calendar.txt nor calendar_dates.txt entries")
+        start_date = min(dates)
+        n_days = (max(dates) - start_date).days + 1
+        day_weekdays = (start_date.weekday() + np.arange(n_days)) % 7
+
+        service_positions = {}
+        for service_id in [c[0] for c in calendar] + [c[0] for c in calendar_dates]:
+            service_positions.setdefault(service_id, len(service_positions))
+
+        active = np.zeros((len(service_positions), n_days), dtype=bool)
+        for service_id, flags, start, end in calendar:
+            lo, hi = (start - start_date).days, (end - start_date).days + 1
+            active[service_positions[service_id], lo:hi] = np.array(flags, dtype=bool)[day_weekdays[lo:hi]]
+        for service_id, date, added in calendar_dates:
+            active[service_positions[service_id], (date - start_date).days] = added
+
+        trip_positions = {}
+        trip_services = []
+        for trip_id, service_id in trip_rows:
+            trip_positions[trip_id] = len(trip_services)
+            # services without any calendar entry never run
+            trip_services.append(service_positions.get(service_id, -1))
+        trip_services = np.array(trip_services, dtype=np.int32)
+
+        trip_hours = None
+        if stop_time_rows is not None:
+            trip_hours = ServiceIndex._first_departure_hours(stop_time_rows, trip_positions)
+
+        logging.debug(f"Service index: {len(service_positions)} services, {n_days} days from {start_date}, "
+                      f"{len(trip_positions)} trips")
+        return ServiceIndex(start_date, active, trip_positions, trip_services, trip_hours)
+
+    @staticmethod
+    def _first_departure_hours(stop_time_rows: Iterable, trip_positions: dict) -> np.ndarray:
+        n_trips = len(trip_positions)
+        trip_hours = np.full(n_trips, -1, dtype=np.int16)
+        first_seqs = np.full(n_trips, np.iinfo(np.int32).max, dtype=np.int32)
+        for trip_id, stop_sequence, departure_time in stop_time_rows:
+            pos = trip_positions.get(trip_id)
+            # times are only mandatory for timepoints, the first stop of a trip always has one
+            if pos is None or not departure_time:
+                continue
+            seq = int(stop_sequence)
+            if seq < first_seqs[pos]:
+                first_seqs[pos] = seq
+                # times past midnight (e.g. 25:10:00) belong to the service day, but run in the early hours
+                trip_hours[pos] = int(departure_time.split(":", 1)[0]) % 24
+        return trip_hours
+
+    def _service_weights(self, window: ServiceWindow) -> np.ndarray:
+        if window.date is not None:
+            day = (window.date - self.start_date).days
+            if not 0 <= day < self.n_days:
+                logging.warning(f"{window.date} is outside of the feed period, no trips will be counted")
+                return np.zeros(self.active.shape[0])
+            day_mask = np.zeros(self.n_days, dtype=bool)
+            day_mask[day] = True
+        else:
+            day_mask = np.ones(self.n_days, dtype=bool)
+
+        if window.weekday is not None:
+            day_mask &= (self.start_date.weekday() + np.arange(self.n_days)) % 7 == window.weekday
+
+        if not day_mask.any():
+            return np.zeros(self.active.shape[0])
+        if window.date is None and window.weekday is None:
+            # no day restriction: every trip counts once, as in the plain trips.txt count
+            return np.ones(self.active.shape[0])
+        return self.active[:, day_mask].mean(axis=1)
+
+    def trip_weights(self, window: ServiceWindow) -> TripWeights:
+        # append a zero weight for trips whose service is unknown (index -1)
+        service_weights = np.append(self._service_weights(window), 0.0)
+        weights = service_weights[self.trip_services]
+
+        if window.hours is not None:
+            if self.trip_hours is None:
+                raise ValueError("Service index was built without departure hours")
+            start, end = window.hours
+            hour_mask = np.zeros(25, dtype=bool)  # last bucket is for trips without departure times
+            if start <= end:
+                hour_mask[start:end] = True
+            else:
+                hour_mask[start:24] = True
+                hour_mask[:end] = True
+            weights = weights * hour_mask[self.trip_hours]
+
+        return TripWeights(self.trip_positions, weights)
+
+    def hourly_trip_weights(self, window: ServiceWindow) -> TripWeights:
+        """
+        Weights of the trips per hour of their first departure, for all days of the window.
+        """
+        if window.hours is not None:
+            raise ValueError("Hourly trip weights cover the whole day, the window cannot have hours")
+        if self.trip_hours is None:
+            raise ValueError("Service index was built without departure hours")
+        weights = np.zeros((len(self.trip_services), HOURS))
+        # trips without departure times (hour -1) are left out
+        with_hours = np.flatnonzero(self.trip_hours >= 0)
+        service_weights = np.append(self._service_weights(window), 0.0)
+        weights[with_hours, self.trip_hours[with_hours]] = service_weights[self.trip_services[with_hours]]
+        return TripWeights(self.trip_positions, weights)
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from citylines.gtfs.domain import BoundingBox, ShapeTrips
+from citylines.gtfs.geo_utils import Window, clip_polyline
+from citylines.gtfs.gtfs import GTFSDataset, MultiFeedDataset, ShapeCache, get_trips_range
+from citylines.gtfs.projection import Projection
+from citylines.gtfs.service_calendar import TripWeights
+from citylines.segments_file import SEGMENTS_FILE, SegmentsFile, write_segments_file
+from citylines.util.files import atomic_open
+
+MANIFEST_FILE = "segments.manifest.json"
+SHAPE_CACHE_FILE = "segments.shapes.npz"
+MANIFEST_VERSION = 1
+
+FEED_FILES = ["routes.txt", "trips.txt", "shapes.txt", "stops.txt", "stop_times.txt",
+              "calendar.txt", "calendar_dates.txt"]
+
+
+def shape_hash(shape: ShapeTrips) -> str:
+    """
+    Content hash of a shape geometry, independent of its shape_id.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(shape.lats.tobytes())
+    h.update(shape.lons.tobytes())
+    return h.hexdigest()
+
+
+def feed_fingerprint(gtfs_dirs: list[str]) -> dict:
+    fingerprint = {}
+    for gtfs_dir in gtfs_dirs:
+        for file_name in FEED_FILES:
+            path = Path(gtfs_dir, file_name)
+            if path.exists():
+                stat = path.stat()
+                fingerprint[str(path)] = [stat.st_size, stat.st_mtime_ns]
+    return fingerprint
+
+
+def extraction_params(bbox: BoundingBox, projection: Projection, window_slug: str | None) -> dict:
+    """
+    Everything besides the feed that determines the projected segments: when it changes, nothing can be reused.
+    """
+    return {"bbox": [bbox.left, bbox.right, bbox.top, bbox.bottom],
+            "render_area": [bbox.render_area.width_px, bbox.render_area.height_px],
+            "projection": projection.kind, "service_window": window_slug}
+
+
+def load_manifest(out_dir: Path) -> dict | None:
+    try:
+        with open(out_dir / MANIFEST_FILE, 'r') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    return manifest if manifest.get("version") == MANIFEST_VERSION else None
+
+
+def _describes_segments(manifest: dict, out_dir: Path) -> bool:
+    # the segments file and the manifest are replaced one after the other, an interruption in between
+    # leaves a manifest of the previous segments file
+    size = manifest.get("segments_size")
+    return size is None or size == (out_dir / SEGMENTS_FILE).stat().st_size
+
+
+def write_manifest(out_dir: Path, params: dict, gtfs_dirs: list[str], shapes: dict):
+    """
+    Records what the segments file in out_dir was built from, see is_up_to_date.
+    """
+    with atomic_open(out_dir / MANIFEST_FILE) as f:
+        json.dump({"version": MANIFEST_VERSION, "params": params, "feed": feed_fingerprint(gtfs_dirs),
+                   "segments_size": (out_dir / SEGMENTS_FILE).stat().st_size, "shapes": shapes}, f)
+
+
+def is_up_to_date(out_dir: Path, gtfs_dirs: list[str], params: dict, require_manifest: bool = False) -> bool:
+    """
+    Segments without a manifest were built by older versions and are kept as they are, unless require_manifest.
+    """
+    if not (out_dir / SEGMENTS_FILE).exists():
+        return False
+    manifest = load_manifest(out_dir)
+    if manifest is None:
+        return not require_manifest
+    return (manifest["feed"] == feed_fingerprint(gtfs_dirs) and manifest["params"] == params
+            and _describes_segments(manifest, out_dir))
+
+
+def update_segments(out_dir: Path, dataset: GTFSDataset | MultiFeedDataset, bbox: BoundingBox, projection: Projection,
+                    trip_weights: TripWeights | None = None, window_slug: str | None = None):
+    """
+    (Re-)builds the segments file of a place. Shapes whose rows in shapes.txt did not change since the previous
+    run are not parsed again, and shapes whose geometry did not change reuse their clipped and projected points:
+    only added and changed shapes are parsed, clipped and projected. Trip counts and max/min trips are always
+    taken from the current feed.
+    """
+    params = extraction_params(bbox, projection, window_slug)
+    manifest = load_manifest(out_dir)
+    previous_shapes = {}
+    previous_points = previous_ranges = None
+    if manifest is not None and manifest["params"] == params and (out_dir / SEGMENTS_FILE).exists() \
+            and _describes_segments(manifest, out_dir):
+        previous_shapes = manifest["shapes"]
+        previous = SegmentsFile.open(out_dir / SEGMENTS_FILE)
+        previous_points = np.array(previous.all_points())
+        previous_ranges = previous.point_ranges()
+    # content hash -> segment range in the previous segments file
+    reusable = {content_hash: (first, n) for content_hash, _, first, n in previous_shapes.values()}
+
+    window = Window.from_bbox(bbox)
+    shape_cache = ShapeCache.load(out_dir / SHAPE_CACHE_FILE, window)
+    shapes = dataset.collect_shapes(bbox, trip_weights, shape_cache)
+    segments = []
+    shape_entries = {}
+    trip_counts = []
+    added, changed, recounted, reused = 0, 0, 0, 0
+
+    for shape in shapes:
+        content_hash = shape_hash(shape)
+        previous_entry = previous_shapes.get(shape.shape_id)
+        if previous_entry is None:
+            added += 1
+        elif previous_entry[0] != content_hash:
+            changed += 1
+        elif previous_entry[1] != shape.trips:
+            recounted += 1
+
+        if content_hash in reusable:
+            first, n = reusable[content_hash]
+            pieces = [previous_points[start:end] for start, end in previous_ranges[first:first + n]]
+            reused += 1
+        else:
+            pieces = [projection.project(piece[:, 0], piece[:, 1])
+                      for piece in clip_polyline(shape.lats, shape.lons, window)]
+
+        shape_entries[shape.shape_id] = [content_hash, shape.trips, len(segments), len(pieces)]
+        if pieces:
+            trip_counts.append(shape.trips)
+        segments.extend((shape.trips, shape.route_type, points) for points in pieces)
+
+    removed = len(set(previous_shapes) - set(shape_entries))
+    logging.info(f"Shapes: {added} added, {changed} changed, {removed} removed, {recounted} with new trip counts, "
+                 f"{reused} of {len(shapes)} reused from the previous run")
+
+    max_trips, min_trips = get_trips_range(trip_counts)
+    write_segments_file(out_dir / SEGMENTS_FILE, segments, max_trips, min_trips)
+    with atomic_open(out_dir / SHAPE_CACHE_FILE, 'wb') as f:
+        shape_cache.save(f)
+    write_manifest(out_dir, params, dataset.gtfs_folder_paths, shape_entries)
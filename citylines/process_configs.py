@@ -1,10 +1,9 @@
+import argparse
 import logging
 from pathlib import Path
 
-from citylines.generate_poster import Poster
-from citylines.gtfs.domain import RenderArea, Point, Distance
-from citylines.trip_extractor import process_gtfs_trips
-from citylines.util.colors import color_schemes
+from citylines.batch import BatchRunner, build_jobs
+from citylines.gtfs.domain import RenderArea, Point
 
 PLACE_CONFIGS = {
     "wroclaw": {
@@ -128,32 +127,32 @@ PLACE_CONFIGS = {
 }
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build posters for all place configs.')
+    parser.add_argument('--places', nargs='*', choices=PLACE_CONFIGS.keys(), help='Only build these places')
+    parser.add_argument('--network-workers', type=int, default=4, help='Concurrent OSM requests')
+    parser.add_argument('--cpu-workers', type=int, help='Concurrent extraction and rendering jobs (default: all cores)')
+    parser.add_argument('--memory-limit-mb', type=int, help='Memory cap of a single extraction or rendering job')
+    parser.add_argument('--no-resume', action='store_true',
+                        help='Run all stages again, even those completed by a previous run')
+    parser.add_argument('--atlas', type=Path, metavar='PDF',
+                        help='Render all posters as the pages of this single PDF, sharing fonts and logos')
+    args = parser.parse_args()
 
-    logger = logging.getLogger(__name__)
+    logger = logging.getLogger()
     handler = logging.StreamHandler()
     formatter = logging.Formatter('%(levelname)s: %(message)s')
     handler.setFormatter(formatter)
     logger.addHandler(handler)
     logger.setLevel(logging.DEBUG)
 
-    for name, place_config in PLACE_CONFIGS.items():
-        render_area = RenderArea.poster()
-        logger.info(f"Processing {name}")
-        for max_dist in place_config["distances"]:
-            logger.info(f"Distance: {max_dist}")
-            out_dir = Path(f"./processed/{name}/{max_dist}")
+    place_configs = {name: PLACE_CONFIGS[name] for name in args.places} if args.places else PLACE_CONFIGS
+    jobs = build_jobs(place_configs, render_area=RenderArea.poster(), atlas_path=args.atlas)
+    runner = BatchRunner(network_workers=args.network_workers, cpu_workers=args.cpu_workers,
+                         memory_limit_mb=args.memory_limit_mb)
+    results = runner.run(jobs, resume=not args.no_resume)
 
-            process_gtfs_trips(center_point=place_config["center"],
-                               out_dir=out_dir,
-                               gtfs_dir=f"./gtfs/{place_config['gtfs']}",
-                               max_dist_y=Distance.from_km(max_dist),
-                               render_area=render_area,
-                               add_water=True,
-                               add_borders=True)
-
-            p = Poster(render_area, out_path=Path(f"./posters/{name}-{max_dist}.pdf"),
-                       input_dir=out_dir, city=name,
-                       logos=place_config["logos"],
-                       text="")
-            color_scheme = color_schemes[place_config.get("color_scheme", "default")]
-            p.generate_single(add_water=True, color_scheme=color_scheme, add_admin_borders=True)
+    failed = [result for result in results.values() if not result.ok]
+    resumed = sum(result.resumed for result in results.values())
+    logger.info(f"{len(results) - len(failed)}/{len(results)} jobs succeeded, {resumed} completed by a previous run")
+    for result in failed:
+        logger.error(f"{result.name}: {'skipped' if result.skipped else result.error}")
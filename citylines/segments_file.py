@@ -0,0 +1,117 @@
+import logging
+import struct
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import numpy as np
+
+from citylines.util.files import atomic_open
+
+SEGMENTS_FILE = "segments.bin"
+
+MAGIC = b"CLSG"
+VERSION = 1
+
+# magic, version, reserved, max trips, min trips, number of segments, reserved, number of points
+HEADER = struct.Struct("<4sHHiiIIQ")
+RECORD_DTYPE = np.dtype([("trips", "<u4"), ("route_type", "<u2"), ("reserved", "<u2"), ("point_offset", "<u8")])
+COORD_DTYPE = np.dtype("<i4")
+
+
+@dataclass(frozen=True)
+class SegmentsFile:
+    """
+    Memory-mapped binary segments file.
+
+    Layout: a fixed header with max/min trips and counts, one record per segment
+    (trips, route type, offset of its first point), then all points as int32 (x, y) pairs.
+    The first point of every segment is absolute, the following ones are deltas to the previous point.
+    """
+    max_trips: int
+    min_trips: int
+    records: np.ndarray
+    coords: np.ndarray
+
+    @staticmethod
+    def open(path: Path) -> 'SegmentsFile':
+        with open(path, 'rb') as f:
+            magic, version, _, max_trips, min_trips, n_segments, _, n_points = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a segments file")
+        if version != VERSION:
+            raise ValueError(f"Unsupported segments file version {version} in {path}")
+
+        records = np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER.size, shape=(n_segments,))
+        coords_offset = HEADER.size + n_segments * RECORD_DTYPE.itemsize
+        coords = np.memmap(path, dtype=COORD_DTYPE, mode='r', offset=coords_offset, shape=(n_points, 2)) \
+            if n_points else np.zeros((0, 2), dtype=COORD_DTYPE)
+        return SegmentsFile(max_trips, min_trips, records, coords)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def point_ranges(self) -> np.ndarray:
+        """
+        (start, end) point index of every segment.
+        """
+        offsets = np.append(self.records["point_offset"], len(self.coords)).astype(np.int64)
+        return np.stack([offsets[:-1], offsets[1:]], axis=1)
+
+    def all_points(self) -> np.ndarray:
+        """
+        Decodes the points of all segments at once, in file order.
+        """
+        cumulative = np.cumsum(self.coords, axis=0, dtype=np.int64)
+        ranges = self.point_ranges()
+        # every segment restarts from an absolute point: subtract what was accumulated before it
+        before = np.zeros((len(ranges), 2), dtype=np.int64)
+        starts = ranges[:, 0]
+        has_before = starts > 0
+        before[has_before] = cumulative[starts[has_before] - 1]
+        return (cumulative - np.repeat(before, ranges[:, 1] - ranges[:, 0], axis=0)).astype(np.int32)
+
+    def __iter__(self) -> Iterator[tuple[int, int, np.ndarray]]:
+        """
+        Yields (trips, route type, points) for every segment.
+        """
+        points = self.all_points()
+        for record, (start, end) in zip(self.records, self.point_ranges()):
+            yield int(record["trips"]), int(record["route_type"]), points[start:end]
+
+
+def write_segments_file(path: Path, segments: Iterable[tuple[int, int, np.ndarray]], max_trips: int, min_trips: int):
+    """
+    :param segments: (trips, route type, (n, 2) pixel points) for every segment
+    """
+    records = []
+    coords = []
+    n_points = 0
+    for trips, route_type, points in segments:
+        points = np.asarray(points, dtype=np.int32).reshape(-1, 2)
+        deltas = points.copy()
+        deltas[1:] -= points[:-1]
+        records.append((trips, route_type, 0, n_points))
+        coords.append(deltas)
+        n_points += len(points)
+
+    with atomic_open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, int(max_trips), int(min_trips), len(records), 0, n_points))
+        f.write(np.array(records, dtype=RECORD_DTYPE).tobytes())
+        if coords:
+            f.write(np.concatenate(coords).astype(COORD_DTYPE).tobytes())
+
+
+def export_text_lines(segments_path: Path, out_dir: Path):
+    """
+    Exports a segments file to the text data.lines and maxmin.lines files.
+    """
+    segments = SegmentsFile.open(segments_path)
+    logging.info(f"Exporting {len(segments)} segments to {out_dir / 'data.lines'}")
+    with atomic_open(out_dir / "data.lines", "w", encoding="utf-8") as file:
+        for trips, route_type, points in segments:
+            coords = ",".join(f"{x} {y}" for x, y in points.tolist())
+            file.write(f"{trips}\t{route_type}\t{coords}\n")
+
+    with atomic_open(out_dir / "maxmin.lines", "w", encoding="utf-8") as file:
+        file.write(f"{segments.max_trips}\n{segments.min_trips}")
@@ -0,0 +1,320 @@
+import argparse
+import datetime
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass, asdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from typing import Callable
+
+from citylines.generate_poster import Poster, PosterScene
+from citylines.gtfs.domain import RenderArea, Point, Distance, ShapeTrips
+from citylines.gtfs.gtfs import compute_segments, ShapeTripIndex
+from citylines.gtfs.projection import Projection, PROJECTIONS, EQUIRECTANGULAR
+from citylines.gtfs.service_calendar import ServiceIndex, ServiceWindow, WEEKDAYS
+from citylines.incremental import feed_fingerprint
+from citylines.trip_extractor import get_render_bbox, extract_admin_borders, extract_water_bodies, create_file, \
+    load_dataset
+from citylines.util.assets import register_fonts
+from citylines.util.colors import color_schemes
+
+# rough per-object overhead of cached shapes and trips, on top of their arrays
+OBJECT_OVERHEAD_BYTES = 200
+
+
+@dataclass(frozen=True)
+class PosterRequest:
+    feeds: tuple[str, ...]
+    center: Point
+    max_dist: int = 20
+    width: int = RenderArea.poster().width_px
+    height: int = RenderArea.poster().height_px
+    color_scheme: str = "default"
+    water: bool = False
+    admin_borders: bool = False
+    projection: str = EQUIRECTANGULAR
+    service_window: ServiceWindow | None = None
+    place_name: str = ""
+    logos: tuple[str, ...] = ()
+    text: str = ""
+
+    @staticmethod
+    def from_json(data: dict) -> 'PosterRequest':
+        """
+        {"gtfs": "helsinki" or [...], "center": [lat, lon], "max_dist": 20, "width": px, "height": px,
+        "color_scheme": ..., "water": bool, "admin_borders": bool, "projection": ..., "date": "YYYY-MM-DD",
+        "weekday": "tuesday", "hours": "7-9", "place_name": ..., "logos": [...], "text": ...}
+        """
+        try:
+            feeds = data["gtfs"]
+            feeds = (feeds,) if isinstance(feeds, str) else tuple(feeds)
+            lat, lon = map(float, data["center"])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("gtfs and center (latitude, longitude) are required")
+        # wrong JSON types are bad requests, not failures of the service
+        for field_name in ("color_scheme", "projection", "date", "weekday", "hours", "place_name", "text"):
+            if field_name in data and not isinstance(data[field_name], str):
+                raise ValueError(f"{field_name} must be a string")
+        if not isinstance(data.get("logos", []), list):
+            raise ValueError("logos must be a list")
+        # feeds and logos are names inside the configured directories, not paths
+        for name in feeds + tuple(data.get("logos", ())) + (data.get("place_name", ""),):
+            if not isinstance(name, str) or "/" in name or "\\" in name or name.startswith("."):
+                raise ValueError(f"Invalid name: {name!r}")
+        if data.get("color_scheme", "default") not in color_schemes:
+            raise ValueError(f"Unknown color scheme: {data['color_scheme']}")
+        if data.get("projection", EQUIRECTANGULAR) not in PROJECTIONS:
+            raise ValueError(f"Unknown projection: {data['projection']}")
+
+        service_window = None
+        if data.get("date") or data.get("weekday") or data.get("hours"):
+            if data.get("weekday") and data["weekday"] not in WEEKDAYS:
+                raise ValueError(f"Unknown weekday: {data['weekday']}")
+            service_window = ServiceWindow(
+                date=datetime.date.fromisoformat(data["date"]) if data.get("date") else None,
+                weekday=WEEKDAYS.index(data["weekday"]) if data.get("weekday") else None,
+                hours=ServiceWindow.parse_hours(data["hours"]) if data.get("hours") else None)
+
+        options = {k: data[k] for k in ("max_dist", "width", "height") if k in data}
+        # bool is a subclass of int, but true is not a width
+        if any(not isinstance(value, int) or isinstance(value, bool) for value in options.values()):
+            raise ValueError("max_dist, width and height must be integers")
+        if any(value <= 0 for value in options.values()):
+            raise ValueError("max_dist, width and height must be positive")
+        for field_name in ("water", "admin_borders"):
+            if field_name in data and not isinstance(data[field_name], bool):
+                raise ValueError(f"{field_name} must be true or false")
+        options.update({k: data[k] for k in ("water", "admin_borders") if k in data})
+        options.update({k: str(data[k]) for k in ("color_scheme", "projection", "place_name", "text") if k in data})
+        return PosterRequest(feeds, Point(lat, lon), service_window=service_window,
+                             logos=tuple(data.get("logos", ())), **options)
+
+    def key(self) -> str:
+        return hashlib.sha1(repr(asdict(self)).encode()).hexdigest()
+
+    def layers_key(self) -> str:
+        """
+        Requests with the same key share their processed OSM layers.
+        """
+        layers = (self.center, self.max_dist, self.width, self.height, self.projection)
+        return hashlib.sha1(repr(layers).encode()).hexdigest()
+
+
+class _InFlight:
+    """
+    Runs identical concurrent calls once: later callers wait for the result of the first one.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._futures = {}
+
+    def run(self, key, func: Callable):
+        with self._lock:
+            future = self._futures.get(key)
+            owner = future is None
+            if owner:
+                future = self._futures[key] = Future()
+        if not owner:
+            return future.result()
+        try:
+            result = func()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._futures[key]
+
+
+class FeedCache:
+    """
+    Parsed feeds and service indexes kept in memory between requests,
+    the least recently used entries are evicted above the memory budget.
+    """
+
+    def __init__(self, memory_budget_bytes: int):
+        self.memory_budget_bytes = memory_budget_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._in_flight = _InFlight()
+
+    @property
+    def size_bytes(self) -> int:
+        with self._lock:
+            return sum(size for _, size in self._entries.values())
+
+    def get(self, key, load: Callable, sizeof: Callable):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+        return self._in_flight.run(key, lambda: self._load(key, load, sizeof))
+
+    def _load(self, key, load: Callable, sizeof: Callable):
+        value = load()
+        size = sizeof(value)
+        with self._lock:
+            self._entries[key] = (value, size)
+            total = sum(s for _, s in self._entries.values())
+            # the new entry stays even if it alone exceeds the budget
+            while total > self.memory_budget_bytes and len(self._entries) > 1:
+                evicted_key, (_, evicted_size) = self._entries.popitem(last=False)
+                total -= evicted_size
+                logging.info(f"Evicted {evicted_key[0]} of {', '.join(evicted_key[1])} ({evicted_size >> 20} MB)")
+        return value
+
+    def status(self) -> list[dict]:
+        with self._lock:
+            return [{"kind": key[0], "feeds": list(key[1]), "size_mb": size / 2 ** 20}
+                    for key, (_, size) in self._entries.items()]
+
+
+def _shape_trip_index_size(index: ShapeTripIndex) -> int:
+    return (sum(shape.lats.nbytes + shape.lons.nbytes + OBJECT_OVERHEAD_BYTES for shape in index.shapes) +
+            index.trip_shapes.nbytes + len(index.trip_ids) * OBJECT_OVERHEAD_BYTES)
+
+
+def _service_index_size(index: ServiceIndex) -> int:
+    trip_hours_size = index.trip_hours.nbytes if index.trip_hours is not None else 0
+    return (index.active.nbytes + index.trip_services.nbytes + trip_hours_size +
+            len(index.trip_positions) * OBJECT_OVERHEAD_BYTES)
+
+
+class RenderService:
+    """
+    Renders posters on request from feeds kept in memory. Only GTFS feeds in gtfs_root are used,
+    OSM layers are fetched once and kept in processed_dir like the processed layers of the CLI.
+    """
+
+    def __init__(self, gtfs_root: Path, processed_dir: Path, posters_dir: Path, memory_budget_mb: int):
+        self.gtfs_root = gtfs_root
+        self.processed_dir = processed_dir
+        self.posters_dir = posters_dir
+        self.cache = FeedCache(memory_budget_mb * 2 ** 20)
+        self._in_flight = _InFlight()
+        register_fonts()
+
+    def _feed_dirs(self, request: PosterRequest) -> list[str]:
+        feed_dirs = [str(self.gtfs_root / feed) for feed in request.feeds]
+        for feed_dir in feed_dirs:
+            if not Path(feed_dir).is_dir():
+                raise ValueError(f"Unknown feed: {Path(feed_dir).name}")
+        return feed_dirs
+
+    def _service_index(self, feed_dirs: list[str], fingerprint: str, with_hours: bool) -> ServiceIndex:
+        return self.cache.get(("service index", tuple(feed_dirs), fingerprint, with_hours),
+                              lambda: load_dataset(feed_dirs).service_index(with_hours=with_hours),
+                              _service_index_size)
+
+    def _shapes(self, feed_dirs: list[str], service_window: ServiceWindow | None) -> list[ShapeTrips]:
+        # feeds updated on disk get new cache entries, the stale ones are evicted eventually
+        fingerprint = json.dumps(feed_fingerprint(feed_dirs))
+        # the feed is parsed once, service windows only weight its trips
+        shape_index = self.cache.get(("shapes", tuple(feed_dirs), fingerprint),
+                                     lambda: load_dataset(feed_dirs).shape_trip_index(), _shape_trip_index_size)
+        trip_weights = None
+        if service_window is not None:
+            index = self._service_index(feed_dirs, fingerprint, service_window.hours is not None)
+            trip_weights = index.trip_weights(service_window)
+        return shape_index.collect_shapes(trip_weights)
+
+    def render(self, request: PosterRequest) -> Path:
+        return self._in_flight.run(request.key(), lambda: self._render(request))
+
+    def _render(self, request: PosterRequest) -> Path:
+        out_path = self.posters_dir / f"{request.key()}.pdf"
+        feed_dirs = self._feed_dirs(request)
+        if out_path.exists() and out_path.stat().st_mtime_ns > max(
+                mtime for _, mtime in feed_fingerprint(feed_dirs).values()):
+            return out_path
+
+        render_area = RenderArea(request.width, request.height)
+        bbox = get_render_bbox(request.center, Distance.from_km(request.max_dist), render_area)
+        layers_dir = self.processed_dir / request.layers_key()
+        out_dir = layers_dir / request.key()
+        out_dir.mkdir(parents=True, exist_ok=True)
+        # requests differing only in styling share the layers, and must not write them concurrently
+        if request.admin_borders:
+            self._in_flight.run((layers_dir, "borders"), lambda: extract_admin_borders(
+                request.center, layers_dir, bbox, projection=request.projection))
+        if request.water:
+            self._in_flight.run((layers_dir, "water"), lambda: extract_water_bodies(
+                layers_dir, bbox, projection=request.projection))
+        # shapes outside of the bbox are rejected by the clipping
+        segments = compute_segments(self._shapes(feed_dirs, request.service_window), bbox)
+        create_file(out_dir, segments, Projection(bbox, request.projection))
+
+        # the poster is written atomically, a cached path never points to a partial PDF
+        poster = Poster(render_area, out_path=out_path, input_dir=out_dir, city=request.place_name,
+                        logos=list(request.logos), text=request.text, logo_forms=True)
+        scene = PosterScene.load(out_dir, render_area, water=request.water, admin_borders=request.admin_borders,
+                                 layers_dir=layers_dir)
+        poster.render_scene(scene, color_schemes[request.color_scheme],
+                            add_water=request.water, add_admin_borders=request.admin_borders)
+        return out_path
+
+
+class _Handler(BaseHTTPRequestHandler):
+    service: RenderService
+
+    def _send(self, status: int, content_type: str, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, data):
+        self._send(status, "application/json", json.dumps(data).encode())
+
+    def do_GET(self):
+        if self.path != "/status":
+            return self._send_json(404, {"error": "Not found"})
+        self._send_json(200, {"cache_mb": self.service.cache.size_bytes / 2 ** 20,
+                              "budget_mb": self.service.cache.memory_budget_bytes / 2 ** 20,
+                              "entries": self.service.cache.status()})
+
+    def do_POST(self):
+        if self.path != "/posters":
+            return self._send_json(404, {"error": "Not found"})
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            out_path = self.service.render(PosterRequest.from_json(data))
+        except (ValueError, json.JSONDecodeError) as e:
+            return self._send_json(400, {"error": str(e)})
+        except Exception as e:
+            logging.exception("Poster request failed")
+            return self._send_json(500, {"error": repr(e)})
+        self._send(200, "application/pdf", out_path.read_bytes())
+
+    def log_message(self, format, *args):
+        logging.info(f"{self.address_string()} {format % args}")
+
+
+def serve(service: RenderService, host: str = "127.0.0.1", port: int = 8765):
+    handler = type("Handler", (_Handler,), {"service": service})
+    with ThreadingHTTPServer((host, port), handler) as server:
+        logging.info(f"Serving posters on http://{host}:{port}/posters")
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local poster rendering service with feeds kept in memory.')
+    parser.add_argument('--gtfs-root', default="gtfs", help='Directory with the GTFS feed directories')
+    parser.add_argument('--processed-dir', default="processed/service", help='Directory for processed layers')
+    parser.add_argument('--posters-dir', default="posters/service", help='Directory for rendered posters')
+    parser.add_argument('--memory-budget-mb', type=int, default=4000, help='Memory budget of the feed cache')
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    serve(RenderService(Path(args.gtfs_root), Path(args.processed_dir), Path(args.posters_dir),
+                        args.memory_budget_mb), host=args.host, port=args.port)
@@ -0,0 +1,147 @@
+import base64
+import json
+import logging
+from pathlib import Path
+from typing import TextIO
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+from citylines.generate_poster import Poster, WATER_COLOR, route_style, to_simple_gtfs_type, get_route_color, to_xy
+from citylines.segments_file import SegmentsFile, SEGMENTS_FILE
+from citylines.util.assets import load_logo
+from citylines.util.colors import ColorScheme
+from citylines.util.files import atomic_open
+
+TEXT_COLOR = "#c8c8c8"
+# water transport routes are dashed with a fixed opacity, as in the PDF
+WATER_TRANSPORT = 15
+
+
+def _hex(color) -> str:
+    return "#%02x%02x%02x" % (round(color.red * 255), round(color.green * 255), round(color.blue * 255))
+
+
+def _coords(values) -> str:
+    return " ".join(map(str, values))
+
+
+def _write_routes(f: TextIO, segments: SegmentsFile, color_scheme: ColorScheme, scaling_w: float):
+    """
+    Routes are grouped by route type and alpha (in 1/255 steps) into <g> elements holding the styles,
+    groups with more trips are drawn on top. Paths are written one at a time straight from the
+    delta-encoded points of the segments file.
+    """
+    records = segments.records
+    n = len(records)
+    route_types = {t: to_simple_gtfs_type(t) for t in np.unique(records["route_type"]).tolist()}
+    simple_types = np.array([route_types[t] for t in records["route_type"].tolist()], dtype=np.int32)
+    alphas = np.empty(n, dtype=np.int32)
+    widths = np.empty(n, dtype=np.float64)
+    for i, trips in enumerate(records["trips"].tolist()):
+        widths[i], alpha = route_style(trips, float(segments.max_trips), scaling_w)
+        alphas[i] = 102 if simple_types[i] == WATER_TRANSPORT else round(alpha * 255)
+
+    order = np.lexsort((np.arange(n), simple_types, alphas))
+    ranges = segments.point_ranges()
+    colors = {}
+    group = None
+    for i in order.tolist():
+        key = (int(alphas[i]), int(simple_types[i]))
+        if key != group:
+            if group is not None:
+                f.write('</g>\n')
+            group = key
+            alpha, simple_type = key
+            if simple_type not in colors:
+                colors[simple_type] = _hex(get_route_color(simple_type, color_scheme))
+            dash = ' stroke-dasharray="10 30"' if simple_type == WATER_TRANSPORT else ''
+            f.write(f'<g stroke="{colors[simple_type]}" stroke-opacity="{alpha / 255:.4f}"{dash}>\n')
+
+        start, end = ranges[i]
+        deltas = segments.coords[start:end]
+        d = f"M{deltas[0, 0]} {deltas[0, 1]}"
+        if end - start > 1:
+            d += "l" + _coords(deltas[1:].ravel().tolist())
+        f.write(f'<path stroke-width="{widths[i]:.2f}" d="{d}"/>\n')
+    if group is not None:
+        f.write('</g>\n')
+
+
+def _write_water_bodies(f: TextIO, input_dir: Path):
+    with open(input_dir / "water_bodies_osm.json", 'r') as water_file:
+        water_bodies = json.load(water_file)
+
+    f.write(f'<g fill="{WATER_COLOR}" fill-rule="evenodd" stroke="none">\n')
+    for body in water_bodies:
+        # islands are holes of the same path
+        rings = [body["nodes"]] + body.get("interiors", [])
+        d = "".join(f"M{_coords(to_xy(ring[0]))}L{_coords(c for point in ring[1:] for c in to_xy(point))}Z"
+                    for ring in rings if len(ring) > 2)
+        if d:
+            f.write(f'<path d="{d}"/>\n')
+    f.write('</g>\n')
+
+
+def _write_admin_borders(f: TextIO, input_dir: Path):
+    with open(input_dir / "borders_osm.json", 'r') as borders_file:
+        way_paths = json.load(borders_file)
+
+    f.write('<g stroke="#ffffff" stroke-width="20">\n')
+    for way_path in way_paths:
+        if way_path:
+            f.write(f'<path d="M{_coords(to_xy(way_path[0]))}L'
+                    f'{_coords(c for point in way_path[1:] for c in to_xy(point))}"/>\n')
+    f.write('</g>\n')
+
+
+def _write_logos_and_text(f: TextIO, poster: Poster):
+    height = poster.render_area.height_px
+    total_w = 0
+    for logo in poster.logos:
+        svg_path = f"assets/logos/{poster.city}/{logo}"
+        drawing = load_logo(svg_path, poster.target_logo_h)
+        data = base64.b64encode(Path(svg_path).read_bytes()).decode()
+        # SVG y axis points down: the logo bottom is at logo_start_y from the bottom edge
+        f.write(f'<image x="{poster.logo_start_x + total_w:.2f}" '
+                f'y="{height - poster.logo_start_y - drawing.height:.2f}" '
+                f'width="{drawing.width:.2f}" height="{drawing.height:.2f}" '
+                f'href="data:image/svg+xml;base64,{data}"/>\n')
+        total_w += drawing.width + poster.logo_gap
+
+    f.write(f'<g fill="{TEXT_COLOR}" font-family="Lato" font-size="{poster.font_size:.2f}">\n')
+    for i, line in enumerate(poster.text.split('\n')):
+        y = height - (poster.extra_text_start_y + i * poster.extra_text_gap_y)
+        f.write(f'<text x="{total_w + poster.extra_text_start_x:.2f}" y="{y:.2f}">{escape(line.strip())}</text>\n')
+    f.write('</g>\n')
+    f.write(f'<text x="{poster.heading_start_x:.2f}" y="{height - poster.heading_start_y:.2f}" fill="{TEXT_COLOR}" '
+            f'font-family="Garamond" font-size="{poster.heading_font_size:.2f}">'
+            f'{escape(poster.city.title())}</text>\n')
+
+
+def write_svg(poster: Poster, color_scheme: ColorScheme, add_water: bool = False, add_admin_borders: bool = False):
+    """
+    Streams the poster to an SVG file at poster.out_path, layer by layer, without building the scene in memory.
+    The page size matches the PDF output.
+    """
+    width, height = poster.render_area.width_px, poster.render_area.height_px
+    segments = SegmentsFile.open(poster.input_dir / SEGMENTS_FILE)
+    poster.out_path.parent.mkdir(parents=True, exist_ok=True)
+
+    with atomic_open(poster.out_path, 'w', encoding='utf-8', buffering=1 << 20) as f:
+        f.write(f'<svg xmlns="http://www.w3.org/2000/svg" width="{width * 0.24:.2f}pt" height="{height * 0.24:.2f}pt" '
+                f'viewBox="0 0 {width} {height}">\n')
+        f.write(f'<title>{escape(poster.city.title())}</title>\n')
+        f.write(f'<rect width="{width}" height="{height}" fill="#000000"/>\n')
+        # scene coordinates are relative to the center, with the y axis pointing up
+        f.write(f'<g transform="translate({width / 2} {height / 2}) scale(1 -1)" fill="none" '
+                f'stroke-linecap="square">\n')
+        if add_water:
+            _write_water_bodies(f, poster.input_dir)
+        if add_admin_borders:
+            _write_admin_borders(f, poster.input_dir)
+        _write_routes(f, segments, color_scheme, poster.scaling_w)
+        f.write('</g>\n')
+        _write_logos_and_text(f, poster)
+        f.write('</svg>\n')
+    logging.info(f"SVG with {len(segments)} route segments written to {poster.out_path}")
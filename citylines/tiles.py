@@ -0,0 +1,267 @@
+import json
+import logging
+import math
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from citylines.generate_poster import PosterScene, get_route_color, fill_even_odd
+from citylines.gtfs.domain import RenderArea
+from citylines.segments_file import SegmentsFile, SEGMENTS_FILE
+from citylines.util.colors import ColorScheme
+from citylines.util.files import atomic_open
+
+TILE_SIZE = 256
+# routes are indexed in chunks of this many points, so that a tile only draws the parts of a route it shows
+CHUNK_POINTS = 64
+POINTS_FILE = "points.npy"
+
+WATER_RGBA = (14, 20, 42, 255)
+BORDER_RGBA = (255, 255, 255, 255)
+
+
+@dataclass(frozen=True)
+class TileLayers:
+    """
+    Everything a tile worker needs besides the route points, which are memory-mapped from points_path.
+    Coordinates are scene pixels relative to the center, as in the processed files.
+    """
+    render_area: RenderArea
+    points_path: Path
+    # (start, end) point ranges of the chunks, consecutive chunks of a route share one point
+    chunk_ranges: np.ndarray
+    chunk_routes: np.ndarray
+    # per route
+    widths: np.ndarray
+    rgba: np.ndarray
+    water_bodies: list[tuple[np.ndarray, list[np.ndarray]]]
+    admin_borders: list[np.ndarray]
+
+    @property
+    def world_size(self) -> int:
+        """
+        Side of the square covered by zoom level 0, the poster is placed at its top left corner.
+        """
+        return max(self.render_area.width_px, self.render_area.height_px)
+
+    def max_zoom(self) -> int:
+        """
+        First zoom level at full poster resolution.
+        """
+        return max(0, math.ceil(math.log2(self.world_size / TILE_SIZE)))
+
+
+def _to_world(points: np.ndarray, render_area: RenderArea) -> np.ndarray:
+    # scene coordinates have the y axis pointing up from the center, tiles have it pointing down from the top
+    world = np.empty(points.shape, dtype=np.float64)
+    world[:, 0] = points[:, 0] + render_area.width_px / 2
+    world[:, 1] = render_area.height_px / 2 - points[:, 1]
+    return world
+
+
+def _tile_index(bboxes: np.ndarray, pad: np.ndarray, scale: float, render_area: RenderArea) -> dict:
+    """
+    Spatial index of one zoom level: (x, y) tile -> ids of the items whose bounding box touches it.
+    Only tiles of the poster page are indexed, the processed layers extend beyond it.
+    :param bboxes: (n, 4) world min x, min y, max x, max y of every item
+    :param pad: half line width of every item, in world pixels
+    """
+    n_tiles = np.array([math.ceil(render_area.width_px * scale / TILE_SIZE),
+                        math.ceil(render_area.height_px * scale / TILE_SIZE)])
+    lo = np.floor((bboxes[:, :2] - pad[:, None]) * scale / TILE_SIZE).astype(np.int64)
+    hi = np.floor((bboxes[:, 2:] + pad[:, None]) * scale / TILE_SIZE).astype(np.int64)
+    on_page = ((hi >= 0) & (lo < n_tiles)).all(axis=1)
+    if not on_page.any():
+        return {}
+    ids = np.flatnonzero(on_page)
+    lo, hi = lo[ids].clip(0, n_tiles - 1), hi[ids].clip(0, n_tiles - 1)
+    spans = hi - lo + 1
+    counts = spans[:, 0] * spans[:, 1]
+
+    # expand every item to the tiles of its bounding box without a Python loop
+    positions = np.repeat(np.arange(len(ids)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    xs = lo[positions, 0] + offsets % spans[positions, 0]
+    ys = lo[positions, 1] + offsets // spans[positions, 0]
+
+    keys = ys * n_tiles[0] + xs
+    order = np.argsort(keys, kind='stable')
+    keys, items = keys[order], ids[positions[order]]
+    boundaries = np.flatnonzero(np.diff(keys)) + 1
+    return {(int(key % n_tiles[0]), int(key // n_tiles[0])): group
+            for key, group in zip(keys[np.append(0, boundaries)], np.split(items, boundaries))}
+
+
+def _bboxes(rings: list[np.ndarray]) -> np.ndarray:
+    if not rings:
+        return np.zeros((0, 4))
+    return np.array([np.concatenate([ring.min(axis=0), ring.max(axis=0)]) for ring in rings])
+
+
+def _clip_ring(ring: np.ndarray, lo: float, hi: float) -> np.ndarray:
+    """
+    Clips a closed ring to the square [lo, hi] x [lo, hi] (Sutherland-Hodgman, vectorized over its edges).
+    Parts outside of the square are replaced by its borders, which keeps the even-odd fill inside it.
+    """
+    for axis, bound, below in ((0, lo, False), (0, hi, True), (1, lo, False), (1, hi, True)):
+        if not len(ring):
+            break
+        inside = ring[:, axis] <= bound if below else ring[:, axis] >= bound
+        if inside.all():
+            continue
+        end, end_inside = np.roll(ring, -1, axis=0), np.roll(inside, -1)
+        # edges along the bound divide by zero, they never cross it and are dropped below
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = (bound - ring[:, axis]) / (end[:, axis] - ring[:, axis])
+            crossing = ring + t[:, None] * (end - ring)
+        crossing[:, axis] = bound
+        # every edge contributes the point where it crosses the bound, and its end point if that is inside
+        keep = np.stack([inside != end_inside, end_inside], axis=1).ravel()
+        ring = np.stack([crossing, end], axis=1).reshape(-1, 2)[keep]
+    return ring
+
+
+_layers: TileLayers | None = None
+_points: np.ndarray | None = None
+
+
+def _init_worker(layers: TileLayers):
+    global _layers, _points
+    _layers = layers
+    _points = np.load(layers.points_path, mmap_mode='r')
+
+
+def _render_tile(task) -> Path:
+    z, x, y, out_path, chunks, water_ids, border_ids = task
+    layers = _layers
+    scale = TILE_SIZE * 2 ** z / layers.world_size
+    offset = np.array([x * TILE_SIZE, y * TILE_SIZE], dtype=np.float64)
+
+    def to_tile(points: np.ndarray) -> list[float]:
+        return (points * scale - offset).ravel().tolist()
+
+    image = Image.new("RGB", (TILE_SIZE, TILE_SIZE), (0, 0, 0))
+    draw = ImageDraw.Draw(image, "RGBA")
+    for i in water_ids:
+        exterior, interiors = layers.water_bodies[i]
+        # bodies are cut to the tile first, so that large ones cost no more than the part a tile shows
+        rings = [_clip_ring(ring * scale - offset, -1.0, TILE_SIZE + 1.0) for ring in [exterior] + interiors]
+        fill_even_odd(image, [ring.ravel().tolist() for ring in rings], WATER_RGBA)
+    border_width = max(1, round(20 * scale))
+    for i in border_ids:
+        draw.line(to_tile(layers.admin_borders[i]), fill=BORDER_RGBA, width=border_width)
+
+    for chunk in chunks:
+        start, end = layers.chunk_ranges[chunk]
+        route = layers.chunk_routes[chunk]
+        points = _to_world(np.asarray(_points[start:end]), layers.render_area)
+        draw.line(to_tile(points), fill=tuple(layers.rgba[route].tolist()),
+                  width=max(1, round(float(layers.widths[route]) * scale)), joint="curve")
+
+    # the layers extend beyond the page, cut tiles at its right and bottom edges as on the poster
+    page_x, page_y = (np.array([layers.render_area.width_px, layers.render_area.height_px]) * scale - offset).tolist()
+    if page_x < TILE_SIZE:
+        draw.rectangle((max(0, math.ceil(page_x)), 0, TILE_SIZE, TILE_SIZE), fill=(0, 0, 0, 255))
+    if page_y < TILE_SIZE:
+        draw.rectangle((0, max(0, math.ceil(page_y)), TILE_SIZE, TILE_SIZE), fill=(0, 0, 0, 255))
+
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    image.save(out_path, optimize=False)
+    return out_path
+
+
+def _prepare_layers(input_dir: Path, points_path: Path, render_area: RenderArea, color_scheme: ColorScheme,
+                    add_water: bool, add_admin_borders: bool) -> TileLayers:
+    scene = PosterScene.load(input_dir, render_area, water=add_water, admin_borders=add_admin_borders)
+    segments = SegmentsFile.open(input_dir / SEGMENTS_FILE)
+    ranges = segments.point_ranges()
+
+    chunk_ranges = []
+    chunk_routes = []
+    for route, (start, end) in enumerate(ranges.tolist()):
+        for chunk_start in range(start, max(end - 1, start + 1), CHUNK_POINTS - 1):
+            chunk_ranges.append((chunk_start, min(chunk_start + CHUNK_POINTS, end)))
+            chunk_routes.append(route)
+
+    np.save(points_path, segments.all_points())
+
+    colors = {}
+    rgba = np.empty((len(scene.routes), 4), dtype=np.uint8)
+    for i, route in enumerate(scene.routes):
+        if route.simple_route_type not in colors:
+            color = get_route_color(route.simple_route_type, color_scheme)
+            colors[route.simple_route_type] = [round(color.red * 255), round(color.green * 255),
+                                               round(color.blue * 255)]
+        # water transport is drawn with a fixed alpha, without the dashes of the poster
+        alpha = 0.4 if route.simple_route_type == 15 else route.alpha
+        rgba[i] = colors[route.simple_route_type] + [round(alpha * 255)]
+
+    water_bodies = [(_to_world(np.array(exterior, dtype=np.float64).reshape(-1, 2), render_area),
+                     [_to_world(np.array(interior, dtype=np.float64).reshape(-1, 2), render_area)
+                      for interior in interiors if len(interior) > 4])
+                    for exterior, interiors in scene.water_bodies if len(exterior) > 4]
+    admin_borders = [_to_world(np.array(way_path, dtype=np.float64).reshape(-1, 2), render_area)
+                     for way_path in scene.admin_borders]
+    return TileLayers(render_area, points_path, np.array(chunk_ranges, dtype=np.int64).reshape(-1, 2),
+                      np.array(chunk_routes, dtype=np.int64), np.array([r.line_width for r in scene.routes]),
+                      rgba, water_bodies, admin_borders)
+
+
+def export_tiles(input_dir: Path, out_dir: Path, render_area: RenderArea, color_scheme: ColorScheme,
+                 add_water: bool = False, add_admin_borders: bool = False, max_zoom: int | None = None,
+                 workers: int | None = None) -> int:
+    """
+    Renders the processed layers into a {z}/{x}/{y}.png tile pyramid. Tiles are in poster pixels
+    (for example a Leaflet map with CRS.Simple), zoom level 0 shows the whole poster in one tile
+    and every level doubles the resolution up to the full poster resolution.
+
+    Route chunks, water bodies and borders are indexed per tile, so a tile only draws what intersects it.
+    Tiles without any feature are not written. Returns the number of written tiles.
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    # the points are only needed while the tiles are rendered, and are removed even if that fails
+    with tempfile.TemporaryDirectory(prefix="citylines-tiles-") as tmp_dir:
+        layers = _prepare_layers(input_dir, Path(tmp_dir) / POINTS_FILE, render_area, color_scheme, add_water,
+                                 add_admin_borders)
+        max_zoom = layers.max_zoom() if max_zoom is None else max_zoom
+
+        points = np.load(layers.points_path, mmap_mode='r')
+        chunk_bboxes = np.zeros((len(layers.chunk_ranges), 4))
+        if len(layers.chunk_ranges):
+            world = _to_world(np.asarray(points), render_area)
+            starts, ends = layers.chunk_ranges[:, 0], layers.chunk_ranges[:, 1]
+            # reduceat covers [start, next start), the last point of a chunk is the first one of the next
+            chunk_bboxes[:, :2] = np.minimum(np.minimum.reduceat(world, starts, axis=0), world[ends - 1])
+            chunk_bboxes[:, 2:] = np.maximum(np.maximum.reduceat(world, starts, axis=0), world[ends - 1])
+        chunk_pad = layers.widths[layers.chunk_routes] / 2
+        water_bboxes = _bboxes([exterior for exterior, _ in layers.water_bodies])
+        border_bboxes = _bboxes(layers.admin_borders)
+
+        tasks = []
+        for z in range(max_zoom + 1):
+            scale = TILE_SIZE * 2 ** z / layers.world_size
+            chunks = _tile_index(chunk_bboxes, chunk_pad, scale, render_area)
+            water = _tile_index(water_bboxes, np.zeros(len(water_bboxes)), scale, render_area)
+            borders = _tile_index(border_bboxes, np.full(len(border_bboxes), 10.0), scale, render_area)
+            empty = np.zeros(0, dtype=np.int64)
+            for x, y in sorted(set(chunks) | set(water) | set(borders)):
+                tasks.append((z, x, y, out_dir / str(z) / str(x) / f"{y}.png",
+                              chunks.get((x, y), empty), water.get((x, y), empty), borders.get((x, y), empty)))
+            logging.debug(f"Zoom {z}: {len(chunks)} tiles with routes")
+
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_init_worker,
+                                 initargs=(layers,)) as pool:
+            for _ in pool.map(_render_tile, tasks, chunksize=16):
+                pass
+
+    # written last, a pyramid with a tiles.json is complete
+    with atomic_open(out_dir / "tiles.json", 'w') as f:
+        json.dump({"tiles": "{z}/{x}/{y}.png", "tile_size": TILE_SIZE, "min_zoom": 0, "max_zoom": max_zoom,
+                   "width": render_area.width_px, "height": render_area.height_px}, f)
+    logging.info(f"{len(tasks)} tiles written to {out_dir}")
+    return len(tasks)
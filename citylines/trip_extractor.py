@@ -1,72 +1,241 @@
 import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from citylines.admin.borders import get_osm_admin_borders
-from citylines.admin.geocode import get_place_relation_id
-from citylines.gtfs.domain import RenderArea, MaxDistance, Distance, BoundingBox
-from citylines.water.oceans import get_ocean_water_bodies
-from citylines.water.other_water import get_osm_water_bodies
-from citylines.gtfs.gtfs import GTFSDataset, SegmentsDataset, coord2px, Point
+import numpy as np
 
+from citylines.gtfs.domain import RenderArea, MaxDistance, Distance, BoundingBox, Point
+from citylines.gtfs.geo_utils import Window, clip_polyline
+from citylines.gtfs.projection import Projection, EQUIRECTANGULAR
+from citylines.gtfs.service_calendar import ServiceIndex, ServiceWindow, HOURS
+from citylines.incremental import is_up_to_date, extraction_params, update_segments, write_manifest
+from citylines.segments_file import SEGMENTS_FILE, write_segments_file
+from citylines.util.files import atomic_open
+from citylines.gtfs.gtfs import GTFSDataset, MultiFeedDataset, SegmentsDataset, get_trips_range
 
-def create_file(out_dir: Path, seg: SegmentsDataset, bbox: BoundingBox):
+WATER_FILE = "water_bodies_osm.json"
+# inland water from Overpass, before the oceans are added
+OSM_WATER_FILE = "water_osm_only.json"
+# routes of the time-of-day animation, next to the layers of the poster
+HOURLY_DIR = "hourly"
+HOURLY_TRIPS_FILE = "hourly_trips.npy"
+
+
+class LayerExtractionError(RuntimeError):
+    """
+    Some layers of a place could not be extracted, the other layers were still written.
+    """
+
+    def __init__(self, errors: dict[str, Exception]):
+        super().__init__("Failed layers: " + ", ".join(f"{layer} ({e!r})" for layer, e in errors.items()))
+        self.errors = errors
+
+
+def create_file(out_dir: Path, seg: SegmentsDataset, projection: Projection):
     segm_length = len(seg.segments)
-    logging.info("Starting to write file: data.lines")
+    logging.info(f"Starting to write file: {SEGMENTS_FILE}")
 
-    # Open the file once for writing
-    with open(out_dir / "data.lines", "w", encoding="utf-8") as file:
+    def projected_segments():
         for idx, segment in enumerate(seg.segments):
-            coords = ",".join(
-                f'{px["x"]} {px["y"]}'
-                for un in segment["coordinates"]
-                for px in [coord2px(float(un["lat"]), float(un["lon"]), bbox)]
-            )
-            route_type = segment["route_type"]
-            line = f"{segment['trips']}\t{route_type}\t{coords}\n"
-            file.write(line)
+            coordinates = segment["coordinates"]
+            points = projection.project(coordinates[:, 0], coordinates[:, 1])
+            yield segment["trips"], segment["route_type"], points
 
             if (segm_length - idx) % 10 == 0:
                 logging.debug(f"{(segm_length - idx)} segments left")
 
-    # Write max and min values
-    logging.info("Starting to write file: maxmin.lines")
-    with open(out_dir / "maxmin.lines", "w", encoding="utf-8") as file:
-        file.write(f"{seg.max_trips_per_seg}\n{seg.min_trips_per_seg}")
-
+    write_segments_file(out_dir / SEGMENTS_FILE, projected_segments(), seg.max_trips_per_seg, seg.min_trips_per_seg)
     logging.info("Write complete")
 
 
-def process_gtfs_trips(center_point: Point, out_dir: Path, gtfs_dir: str, max_dist_y: Distance,
-                       render_area: RenderArea, add_water: bool, add_borders: bool):
+def get_render_bbox(center_point: Point, max_dist_y: Distance, render_area: RenderArea) -> BoundingBox:
+    max_dist = MaxDistance.from_distance(max_dist_y, render_area)
+    return BoundingBox.from_center(center_point, max_dist, render_area=render_area)
+
+
+def extract_admin_borders(center_point: Point, out_dir: Path, bbox: BoundingBox, projection: str = EQUIRECTANGULAR,
+                          force: bool = False):
+    """
+    :param force: fetch the borders again even if the file exists
+    """
+    if not force and (out_dir / "borders_osm.json").exists():
+        return
+    # OSM layer modules pull in requests, geopandas and shapely, they are imported only when a layer is extracted
+    from citylines.admin.borders import get_osm_admin_borders
+    from citylines.admin.geocode import get_place_relation_id
+
+    logging.debug("Extracting borders...")
+    place_id = get_place_relation_id(center_point.lat, center_point.lon)
+    borders = get_osm_admin_borders(place_id=place_id, bbox=bbox, projection=Projection(bbox, projection))
+    with atomic_open(out_dir / "borders_osm.json") as f:
+        json.dump(borders, f)
+
+
+def extract_water_bodies(out_dir: Path, bbox: BoundingBox, projection: str = EQUIRECTANGULAR):
+    if (out_dir / WATER_FILE).exists():
+        return
+    from citylines.water.oceans import get_ocean_water_bodies
+    from citylines.water.other_water import get_osm_water_bodies
+
+    logging.debug("Extracting water bodies...")
+    water_projection = Projection(bbox, projection)
+    # the ocean shapefile is read while waiting for the Overpass query
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        oceans = executor.submit(get_ocean_water_bodies, bbox_orig=bbox, projection=water_projection)
+        water_bodies = get_osm_water_bodies(bbox=bbox, projection=water_projection)
+        water_bodies.extend(oceans.result())
+    with atomic_open(out_dir / WATER_FILE) as f:
+        json.dump(water_bodies, f)
+
+
+def fetch_osm_water(out_dir: Path, bbox: BoundingBox, projection: str = EQUIRECTANGULAR):
+    """
+    First half of extract_water_bodies for schedulers that run network and CPU work separately:
+    only the Overpass query, completed by add_ocean_water.
+    """
+    from citylines.water.other_water import get_osm_water_bodies
+
+    water_bodies = get_osm_water_bodies(bbox=bbox, projection=Projection(bbox, projection))
+    with atomic_open(out_dir / OSM_WATER_FILE) as f:
+        json.dump(water_bodies, f)
+
+
+def add_ocean_water(out_dir: Path, bbox: BoundingBox, projection: str = EQUIRECTANGULAR):
+    """
+    Second half of extract_water_bodies: clips the oceans from the shapefile, which is read whole
+    into memory, and writes them together with the water fetched by fetch_osm_water.
+    """
+    from citylines.water.oceans import get_ocean_water_bodies
+
+    with open(out_dir / OSM_WATER_FILE, 'r') as f:
+        water_bodies = json.load(f)
+    water_bodies.extend(get_ocean_water_bodies(bbox_orig=bbox, projection=Projection(bbox, projection)))
+    with atomic_open(out_dir / WATER_FILE) as f:
+        json.dump(water_bodies, f)
+
+
+def load_dataset(gtfs_dirs: list[str]) -> GTFSDataset | MultiFeedDataset:
+    """
+    Several feed directories are combined into one dataset.
+    """
+    if len(gtfs_dirs) == 1:
+        return GTFSDataset.from_path(gtfs_dirs[0])
+    return MultiFeedDataset.from_paths(gtfs_dirs)
+
+
+def extract_routes(center_point: Point, out_dir: Path, gtfs_dir: str | list[str], max_dist_y: Distance,
+                   render_area: RenderArea, service_window: ServiceWindow | None = None,
+                   service_index: ServiceIndex | None = None, projection: str = EQUIRECTANGULAR):
     max_dist = MaxDistance.from_distance(max_dist_y, render_area)
     bbox = BoundingBox.from_center(center_point, max_dist, render_area=render_area)
+    route_projection = Projection(bbox, projection)
+    window_slug = service_window.slug() if service_window is not None else None
+    gtfs_dirs = [gtfs_dir] if isinstance(gtfs_dir, str) else list(gtfs_dir)
+    if is_up_to_date(out_dir, gtfs_dirs, extraction_params(bbox, route_projection, window_slug)):
+        logging.debug(f"{SEGMENTS_FILE} file in {out_dir} is up to date, skipping re-generation")
+        return
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    if add_borders and not (out_dir / "borders_osm.json").exists():
-        logging.debug("Extracting borders...")
-        place_id = get_place_relation_id(center_point.lat, center_point.lon)
-        borders = get_osm_admin_borders(place_id=place_id, bbox=bbox)
-        with open(out_dir / "borders_osm.json", 'w') as f:
-            json.dump(borders, f)
-
-    if add_water and not (out_dir / "water_bodies_osm.json").exists():
-        logging.debug("Extracting water bodies...")
-        water_bodies = get_osm_water_bodies(bbox=bbox)
-        water_bodies.extend(get_ocean_water_bodies(bbox_orig=bbox))
-        with open(out_dir / "water_bodies_osm.json", 'w') as f:
-            json.dump(water_bodies, f)
-
-    if not (out_dir / "data.lines").exists():
-        logging.debug(f"GTFS provider: {gtfs_dir}")
-        logging.debug(f"Render area: {render_area.width_px} x {render_area.height_px} px")
-        logging.debug(f"Center coordinates: {center_point}")
-        logging.debug(f"Max distance from center: {max_dist.x}x{max_dist.y}km")
-
-        logging.debug("Computing GTFS segments data...")
-        dataset = GTFSDataset.from_path(gtfs_dir)
-        segments = dataset.compute_segments(center_point, max_dist)
-        create_file(out_dir, segments, bbox)
-        logging.debug(f"Route frequency files written to {out_dir}")
-    else:
-        logging.debug(f"data.lines file in {out_dir} already exists, skipping re-generation")
+    logging.debug(f"GTFS provider: {gtfs_dir}")
+    logging.debug(f"Render area: {render_area.width_px} x {render_area.height_px} px")
+    logging.debug(f"Center coordinates: {center_point}")
+    logging.debug(f"Max distance from center: {max_dist.x}x{max_dist.y}km")
+
+    logging.debug("Computing GTFS segments data...")
+    dataset = load_dataset(gtfs_dirs)
+    trip_weights = None
+    if service_window is not None:
+        logging.debug(f"Service window: {service_window.slug()}")
+        if service_index is None:
+            service_index = dataset.service_index(with_hours=service_window.hours is not None)
+        trip_weights = service_index.trip_weights(service_window)
+    update_segments(out_dir, dataset, bbox, route_projection, trip_weights=trip_weights, window_slug=window_slug)
+    logging.debug(f"Route frequency files written to {out_dir}")
+
+
+def extract_hourly_routes(center_point: Point, out_dir: Path, gtfs_dir: str | list[str], max_dist_y: Distance,
+                          render_area: RenderArea, service_window: ServiceWindow | None = None,
+                          service_index: ServiceIndex | None = None, projection: str = EQUIRECTANGULAR):
+    """
+    Routes of a time-of-day animation, written to out_dir/hourly: a segments file with the trips of the whole day,
+    and the trips of every segment per hour of their first departure. Shapes are clipped and projected once,
+    trips per hour come from the same pass over the feed.
+    :param service_window: date or weekday the trips are counted for, without hours
+    """
+    hourly_dir = out_dir / HOURLY_DIR
+    bbox = get_render_bbox(center_point, max_dist_y, render_area)
+    route_projection = Projection(bbox, projection)
+    gtfs_dirs = [gtfs_dir] if isinstance(gtfs_dir, str) else list(gtfs_dir)
+    params = extraction_params(bbox, route_projection, service_window.slug() if service_window is not None else None)
+    # hourly routes written without a manifest cannot be checked, they are extracted again
+    if (hourly_dir / HOURLY_TRIPS_FILE).exists() and is_up_to_date(hourly_dir, gtfs_dirs, params,
+                                                                   require_manifest=True):
+        logging.debug(f"Hourly routes in {hourly_dir} are up to date, skipping re-generation")
+        return
+    hourly_dir.mkdir(parents=True, exist_ok=True)
+    window = Window.from_bbox(bbox)
+
+    logging.debug("Computing hourly GTFS segments data...")
+    dataset = load_dataset(gtfs_dirs)
+    if service_index is None:
+        service_index = dataset.service_index(with_hours=True)
+    trip_weights = service_index.hourly_trip_weights(service_window or ServiceWindow())
+
+    segments = []
+    hourly_trips = []
+    for shape in dataset.collect_shapes(bbox, trip_weights):
+        trips = max(1, round(float(shape.trips.sum())))
+        for piece in clip_polyline(shape.lats, shape.lons, window):
+            segments.append((trips, shape.route_type, route_projection.project(piece[:, 0], piece[:, 1])))
+            hourly_trips.append(shape.trips)
+
+    max_trips, min_trips = get_trips_range([trips for trips, _, _ in segments])
+    write_segments_file(hourly_dir / SEGMENTS_FILE, segments, max_trips, min_trips)
+    with atomic_open(hourly_dir / HOURLY_TRIPS_FILE, 'wb') as f:
+        np.save(f, np.array(hourly_trips, dtype=np.float32).reshape(-1, HOURS))
+    # written last, the manifest describes a complete pair of files
+    write_manifest(hourly_dir, params, gtfs_dirs, {})
+    logging.debug(f"Hourly routes of {len(segments)} segments written to {hourly_dir}")
+
+
+def process_gtfs_trips(center_point: Point, out_dir: Path, gtfs_dir: str | list[str], max_dist_y: Distance,
+                       render_area: RenderArea, add_water: bool, add_borders: bool,
+                       service_window: ServiceWindow | None = None, service_index: ServiceIndex | None = None,
+                       projection: str = EQUIRECTANGULAR, hourly: bool = False):
+    """
+    :param gtfs_dir: a feed directory, or several directories of feeds covering the same area
+    :param service_window: count only the trips running in this window (date, weekday, hours)
+    :param service_index: prebuilt service index of the feed, to share between several windows
+    :param projection: map projection of all layers, one of citylines.gtfs.projection.PROJECTIONS
+    :param hourly: extract the routes of the time-of-day animation instead of the poster routes
+    """
+    bbox = get_render_bbox(center_point, max_dist_y, render_area)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    # the network bound layers are fetched in the background while the routes are extracted,
+    # a failing layer does not stop the others
+    errors = {}
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        layers = {}
+        if add_borders:
+            layers["borders"] = executor.submit(extract_admin_borders, center_point, out_dir, bbox,
+                                                projection=projection)
+        if add_water:
+            layers["water"] = executor.submit(extract_water_bodies, out_dir, bbox, projection=projection)
+        try:
+            (extract_hourly_routes if hourly else extract_routes)(
+                center_point, out_dir, gtfs_dir, max_dist_y, render_area,
+                service_window=service_window, service_index=service_index, projection=projection)
+        except Exception as e:
+            errors["routes"] = e
+        for layer, future in layers.items():
+            try:
+                future.result()
+            except Exception as e:
+                errors[layer] = e
+
+    if errors:
+        for layer, e in errors.items():
+            logging.error(f"Extracting {layer} in {out_dir} failed: {e!r}")
+        raise LayerExtractionError(errors) from next(iter(errors.values()))
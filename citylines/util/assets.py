@@ -0,0 +1,67 @@
+import hashlib
+from functools import lru_cache
+
+from reportlab.graphics import renderPDF
+from reportlab.graphics.shapes import Drawing
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen.canvas import Canvas
+from svglib.svglib import svg2rlg
+
+FONTS = {
+    'Lato': 'assets/fonts/Lato-Regular.ttf',
+    'Garamond': 'assets/fonts/EBGaramond-VariableFont_wght.ttf',
+}
+
+
+def register_fonts():
+    """
+    Registers the poster fonts, TTF files are parsed once per process.
+    """
+    registered = set(pdfmetrics.getRegisteredFontNames())
+    for name, path in FONTS.items():
+        if name not in registered:
+            pdfmetrics.registerFont(TTFont(name, path))
+
+
+@lru_cache(maxsize=64)
+def load_logo(svg_path: str, height: float) -> Drawing:
+    """
+    Parses an SVG logo and scales it to the given height, memoized by (path, height).
+    The returned drawing is shared and must not be modified.
+    """
+    drawing = svg2rlg(svg_path)
+
+    # If only height is provided, calculate the scaling factor based on the height,
+    # then compute the resultant width based on the original aspect ratio.
+    scaling_factor = height / drawing.height
+    resultant_width = drawing.width * scaling_factor
+    drawing.width = resultant_width
+    drawing.height = height
+    drawing.scale(scaling_factor, scaling_factor)
+    return drawing
+
+
+def draw_logo(c: Canvas, svg_path: str, x: float, y: float, height: float, as_form: bool = False):
+    """
+    Draws a logo, optionally through a PDF form XObject that is embedded once per document
+    and referenced every time the same logo is drawn again.
+    """
+    drawing = load_logo(svg_path, height)
+    if not as_form:
+        renderPDF.draw(drawing, c, x, y)
+        return drawing.width, drawing.height
+
+    form_name = "logo_" + hashlib.md5(f"{svg_path}:{height}".encode()).hexdigest()
+    if not c.hasForm(form_name):
+        # some logos draw slightly outside of their declared size, the form must not clip them
+        min_x, min_y, max_x, max_y = drawing.getBounds()
+        c.beginForm(form_name, lowerx=min(min_x, 0), lowery=min(min_y, 0),
+                    upperx=max(max_x, drawing.width), uppery=max(max_y, drawing.height))
+        renderPDF.draw(drawing, c, 0, 0)
+        c.endForm()
+    c.saveState()
+    c.translate(x, y)
+    c.doForm(form_name)
+    c.restoreState()
+    return drawing.width, drawing.height
@@ -0,0 +1,22 @@
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+
+@contextmanager
+def atomic_open(path: Path, mode: str = 'w', **kwargs):
+    """
+    Opens a temporary file next to path, which replaces path only when the block completes,
+    so that an interrupted write never leaves a partial file behind. Concurrent writers of the same path
+    use separate temporary files, the last one to complete wins.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp_path, mode, **kwargs) as f:
+            yield f
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
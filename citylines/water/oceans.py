@@ -1,16 +1,24 @@
 import geopandas as gpd
+import numpy as np
 from shapely.geometry import box
 
-from citylines.gtfs.gtfs import BoundingBox, coord2px
+from citylines.gtfs.domain import BoundingBox
+from citylines.gtfs.projection import Projection
 
 
-def process_polygon(polygon, bbox_orig: BoundingBox):
-    exterior_nodes = [coord2px(lat, lon, bbox_orig) for lon, lat in polygon.exterior.coords]
-    interiors = [[coord2px(lat, lon, bbox_orig) for lon, lat in interior.coords] for interior in polygon.interiors]
+def _project_ring(ring, projection: Projection) -> list:
+    coords = np.asarray(ring.coords)
+    return projection.project(coords[:, 1], coords[:, 0]).tolist()
+
+
+def process_polygon(polygon, projection: Projection):
+    exterior_nodes = _project_ring(polygon.exterior, projection)
+    interiors = [_project_ring(interior, projection) for interior in polygon.interiors]
     return {"nodes": exterior_nodes, "name": "ocean", "interiors": interiors}
 
 
-def get_ocean_water_bodies(bbox_orig: BoundingBox):
+def get_ocean_water_bodies(bbox_orig: BoundingBox, projection: Projection | None = None):
+    projection = projection or Projection(bbox_orig)
     # Load the Natural Earth Data
     water_gdf = gpd.read_file('oceans/water_polygons.shp')
     bbox = box(bbox_orig.left, bbox_orig.bottom, bbox_orig.right, bbox_orig.top)
@@ -21,8 +29,8 @@ def get_ocean_water_bodies(bbox_orig: BoundingBox):
     result = []
     for geometry in filtered_water_gdf.geometry:
         if geometry.geom_type == 'Polygon':
-            result.append(process_polygon(geometry, bbox_orig))
+            result.append(process_polygon(geometry, projection))
         elif geometry.geom_type == 'MultiPolygon':
-            for polygon in geometry:
-                result.append(process_polygon(polygon, bbox_orig))
+            for polygon in geometry.geoms:
+                result.append(process_polygon(polygon, projection))
     return result
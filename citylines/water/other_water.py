@@ -2,7 +2,8 @@ from itertools import chain
 
 import requests
 
-from citylines.gtfs.gtfs import BoundingBox, coord2px
+from citylines.gtfs.domain import BoundingBox
+from citylines.gtfs.projection import Projection
 
 
 def order_ways(ways):
@@ -33,7 +34,7 @@ def order_ways(ways):
     return list(chain.from_iterable(ordered_ways))
 
 
-def get_osm_water_bodies(bbox: BoundingBox) -> list[dict]:
+def get_osm_water_bodies(bbox: BoundingBox, projection: Projection | None = None) -> list[dict]:
     overpass_url = "https://overpass-api.de/api/interpreter"
     query = f"""
     [out:json][bbox:{bbox.bottom},{bbox.left},{bbox.top},{bbox.right}];
@@ -53,11 +54,12 @@ def get_osm_water_bodies(bbox: BoundingBox) -> list[dict]:
     relations = []
     way_dict = {}
     node_dict = {}
-    # first nodes
-    for n in data["elements"]:
-        if n["type"] == "node":
-            px = coord2px(n["lat"], n["lon"], bbox)
-            node_dict[n["id"]] = px
+    # first nodes, projected all at once
+    nodes = [n for n in data["elements"] if n["type"] == "node"]
+    projection = projection or Projection(bbox)
+    pixels = projection.project([n["lat"] for n in nodes], [n["lon"] for n in nodes]).tolist()
+    for n, px in zip(nodes, pixels):
+        node_dict[n["id"]] = px
     # then ways
     for w in data["elements"]:
         if w["type"] == "way":
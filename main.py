@@ -1,9 +1,12 @@
 import argparse
+import datetime
 import logging
 from pathlib import Path
 
-from citylines.generate_poster import Poster
 from citylines.gtfs.domain import RenderArea, Point, Distance
+from citylines.gtfs.projection import PROJECTIONS, EQUIRECTANGULAR
+from citylines.gtfs.service_calendar import ServiceWindow, WEEKDAYS
+from citylines.segments_file import export_text_lines, SEGMENTS_FILE
 from citylines.trip_extractor import process_gtfs_trips
 from citylines.util.colors import color_schemes
 
@@ -12,7 +15,8 @@ if __name__ == "__main__":
     logging.getLogger('fiona.ogrext').setLevel(logging.WARNING)
 
     parser = argparse.ArgumentParser(description='Process GTFS data to output lines.')
-    parser.add_argument('--gtfs', required=True, help='Path to the input gtfs directory')
+    parser.add_argument('--gtfs', required=True, nargs='+',
+                        help='Path to the input gtfs directory, or several directories of feeds covering the area')
     parser.add_argument('--processed-dir', default="processed",
                         help="Base path to the processed gtfs directory (will be created if doesn't exist)")
     parser.add_argument('--max-dist', type=int, default=20,
@@ -30,6 +34,28 @@ if __name__ == "__main__":
                         help='List of logos for the poster (inside ./assets/logos/{place_name}/)')
     parser.add_argument('--color-scheme', choices=color_schemes.keys(), default='default',
                         help='Choose a color scheme for the poster. Allowed values are: %(choices)s')
+    parser.add_argument('--date', type=datetime.date.fromisoformat,
+                        help='Count only trips running on this date (YYYY-MM-DD)')
+    parser.add_argument('--weekday', choices=WEEKDAYS,
+                        help='Count trips of a typical weekday, averaged over the feed period')
+    parser.add_argument('--hours', help='Count only trips departing within these hours, e.g. 7-9')
+    parser.add_argument('--projection', choices=PROJECTIONS, default=EQUIRECTANGULAR,
+                        help='Map projection of the poster. Allowed values are: %(choices)s')
+    parser.add_argument('--format', choices=['pdf', 'svg'], default='pdf',
+                        help='Output format of the poster. Allowed values are: %(choices)s')
+    parser.add_argument('--preview', type=int, nargs='?', const=800, metavar='WIDTH',
+                        help='Render a quick low-detail preview of this width (in px, default 800) instead of the poster')
+    parser.add_argument('--density', action='store_true',
+                        help='Draw the routes as a trip-density heatmap, for very dense feeds')
+    parser.add_argument('--animation', type=int, nargs='?', const=1080, metavar='WIDTH',
+                        help='Render a time-of-day animation of this width (in px, default 1080): '
+                             'one frame per departure hour and a GIF')
+    parser.add_argument('--extract-only', action='store_true',
+                        help='Only extract the processed layers, without rendering anything')
+    parser.add_argument('--tiles', action='store_true',
+                        help='Export a zoomable {z}/{x}/{y}.png tile pyramid instead of the poster')
+    parser.add_argument('--export-text', action='store_true',
+                        help='Also export the route segments as text data.lines and maxmin.lines files')
 
     args = parser.parse_args()
 
@@ -41,17 +67,74 @@ if __name__ == "__main__":
     else:
         parser.error("Either both width and height must be provided, or --poster must be set.")
 
+    service_window = None
+    if args.date or args.weekday or args.hours:
+        try:
+            hours = ServiceWindow.parse_hours(args.hours) if args.hours else None
+        except ValueError as e:
+            parser.error(str(e))
+        weekday = WEEKDAYS.index(args.weekday) if args.weekday else None
+        service_window = ServiceWindow(date=args.date, weekday=weekday, hours=hours)
+
+    if args.animation and args.hours:
+        parser.error("--animation covers all hours of the day, it cannot be combined with --hours.")
+    if args.preview and args.format == 'svg':
+        parser.error("Previews are rendered as PDF, --preview cannot be combined with --format svg.")
+    if args.density and (args.preview or args.format == 'svg' or args.tiles or args.animation):
+        parser.error("--density is only supported for the full PDF poster, "
+                     "it cannot be combined with --preview, --format svg, --tiles or --animation.")
+
     dist = Distance.from_km(args.max_dist)
-    out_dir = Path(f"{args.processed_dir}/{args.place_name}/{dist.km()}")
+    variant = f"{dist.km()}" if service_window is None else f"{dist.km()}-{service_window.slug()}"
+    # water and borders are stored in projected pixels, each projection keeps its own layers
+    if args.projection != EQUIRECTANGULAR:
+        variant = f"{variant}-{args.projection}"
+    out_dir = Path(f"{args.processed_dir}/{args.place_name}/{variant}")
 
     process_gtfs_trips(center_point=Point(center_lat, center_lon), out_dir=out_dir, gtfs_dir=args.gtfs,
-                       max_dist_y=dist, render_area=render_area, add_water=args.water, add_borders=args.admin_borders)
-    logging.info("Generating pdf image...")
-
-    image_filepath = Path(f"./posters/{args.place_name}-{dist.km()}.pdf")
-    p = Poster(render_area, out_path=image_filepath,
-               input_dir=out_dir, city=args.place_name,
-               logos=[logo for logo in args.logos], text="")
-    p.generate_single(add_water=args.water, add_admin_borders=args.admin_borders,
+                       max_dist_y=dist, render_area=render_area, add_water=args.water, add_borders=args.admin_borders,
+                       service_window=service_window, projection=args.projection, hourly=bool(args.animation))
+    if args.export_text and not args.animation:
+        export_text_lines(out_dir / SEGMENTS_FILE, out_dir)
+    # rendering dependencies are only imported when something is rendered
+    if args.extract_only:
+        logging.info(f"Processed layers written to {out_dir}")
+    elif args.animation:
+        from citylines.animation import render_animation
+
+        frames_dir = Path(f"./posters/{args.place_name}-{variant}-animation")
+        frame_area = RenderArea(args.animation, round(args.animation * render_area.height_px / render_area.width_px))
+        render_animation(out_dir, frames_dir, render_area, frame_area, color_schemes[args.color_scheme],
+                         city=args.place_name, add_water=args.water, add_admin_borders=args.admin_borders,
+                         gif_path=Path(f"./posters/{args.place_name}-{variant}.gif"))
+        logging.info(f"Animation frames generated at {frames_dir}")
+    elif args.tiles:
+        from citylines.tiles import export_tiles
+
+        tiles_dir = Path(f"./posters/{args.place_name}-{variant}-tiles")
+        export_tiles(out_dir, tiles_dir, render_area, color_scheme=color_schemes[args.color_scheme],
+                     add_water=args.water, add_admin_borders=args.admin_borders)
+        logging.info(f"Tiles generated at {tiles_dir}")
+    else:
+        from citylines.generate_poster import Poster
+        from citylines.svg_output import write_svg
+
+        logging.info("Generating poster...")
+
+        image_filepath = Path(f"./posters/{args.place_name}-{variant}.{args.format}")
+        if args.preview:
+            image_filepath = image_filepath.with_name(f"{args.place_name}-{variant}-preview.pdf")
+        p = Poster(render_area, out_path=image_filepath,
+                   input_dir=out_dir, city=args.place_name,
+                   logos=[logo for logo in args.logos], text="")
+        if args.preview:
+            preview_area = RenderArea(args.preview, round(args.preview * render_area.height_px / render_area.width_px))
+            p.generate_preview(preview_area, add_water=args.water, add_admin_borders=args.admin_borders,
+                               color_scheme=color_schemes[args.color_scheme])
+        elif args.format == 'svg':
+            write_svg(p, add_water=args.water, add_admin_borders=args.admin_borders,
                       color_scheme=color_schemes[args.color_scheme])
-    logging.info(f"PDF generated at {image_filepath}")
+        else:
+            p.generate_single(add_water=args.water, add_admin_borders=args.admin_borders,
+                              color_scheme=color_schemes[args.color_scheme], density=args.density)
+        logging.info(f"Poster generated at {image_filepath}")